@@ -0,0 +1,101 @@
+import functools
+import logging
+import time
+from collections import deque
+
+from telegram import Update
+from telegram.ext import Application, ApplicationHandlerStop, ConversationHandler
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _timed(callback):
+    # records every call of a handler callback in metrics.HANDLERS
+    name = f"{callback.__module__}.{callback.__qualname__}"
+
+    @functools.wraps(callback)
+    async def timed(update, context):
+        started = time.perf_counter()
+        error = False
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            error = True
+            raise
+        finally:
+            metrics.HANDLERS.observe(name, time.perf_counter() - started, error)
+
+    timed.timed = True
+    return timed
+
+
+def _instrument(handler):
+    if isinstance(handler, ConversationHandler):
+        for inner in handler.entry_points + handler.fallbacks:
+            _instrument(inner)
+        for state_handlers in handler.states.values():
+            for inner in state_handlers:
+                _instrument(inner)
+    elif not getattr(handler.callback, "timed", False):
+        handler.callback = _timed(handler.callback)
+
+
+class OrderedApplication(Application):
+    # With concurrent_updates on, up to that many updates are handled at once,
+    # but each user's own updates still run one at a time in arrival order, so
+    # "Начал" is always handled before the "Отошел" sent right after it and a
+    # conversation never sees two of its steps at once. A user's later updates
+    # wait in a queue of their own, outside the concurrent_updates slots, so
+    # one user sending many updates in a row never holds up everyone else.
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._user_queues = {}  # user or chat id -> updates not yet handled, the running one first
+
+    @staticmethod
+    def _order_key(update: object):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return None
+
+    def add_handler(self, handler, group: int = 0) -> None:
+        # every handler is timed, the ones inside conversations included
+        _instrument(handler)
+        super().add_handler(handler, group)
+
+    async def _handle_in_slot(self, update: object) -> None:
+        try:
+            async with self._concurrent_updates_sem:
+                await self.process_update(update)
+        except Exception:
+            # one failed update must not drop the ones queued behind it
+            logger.exception("processing update %s failed", update)
+        finally:
+            self.update_queue.task_done()
+
+    async def _Application__process_update_wrapper(self, update: object) -> None:
+        # replaces Application.__process_update_wrapper, which the update
+        # fetcher starts as a task for every update it takes off update_queue
+        key = self._order_key(update)
+        if key is None:
+            await self._handle_in_slot(update)
+            return
+        queue = self._user_queues.get(key)
+        if queue is not None:
+            # the task handling this user's earlier update picks it up
+            queue.append(update)
+            return
+        queue = self._user_queues[key] = deque([update])
+        try:
+            while queue:
+                await self._handle_in_slot(queue[0])
+                queue.popleft()
+        finally:
+            del self._user_queues[key]
@@ -0,0 +1,48 @@
+import datetime
+import logging
+
+from telegram.error import BadRequest, Forbidden
+from config import AUTO_CLOSE_AFTER_HOURS, AUTO_CLOSE_BATCH, AUTO_CLOSE_INTERVAL_SECONDS
+from database import run_db
+from models import auto_close_sessions
+from rate_limiter import LANE_BULK
+
+logger = logging.getLogger(__name__)
+
+# Sessions nobody ended with "Закончил" are closed here, up to AUTO_CLOSE_BATCH
+# per run in a single statement (models.AUTO_CLOSE_SESSIONS); a longer backlog
+# is worked off by the following runs. Employees are told afterwards about
+# their current session; older duplicates and stray breaks are only logged.
+
+
+async def tick(context):
+    now = datetime.datetime.now()
+    cutoff = now - datetime.timedelta(hours=AUTO_CLOSE_AFTER_HOURS)
+    sessions, breaks = await run_db(auto_close_sessions, cutoff, now, AUTO_CLOSE_BATCH)
+    if not sessions and not breaks:
+        return
+    current = [row[:4] for row in sessions if row[4]]
+    logger.info("auto-closed %d sessions (%d not current) and %d breaks started before %s",
+                len(sessions), len(sessions) - len(current), breaks, cutoff.isoformat(timespec="minutes"))
+    if current:
+        # sending can take a while; the next run must not wait for it
+        context.application.create_task(_notify(context.bot, current))
+
+
+async def _notify(bot, closed):
+    for employee_id, chat_id, started_at, ended_at in closed:
+        text = (f"Рабочий день, начатый {started_at:%d.%m в %H:%M}, не был завершён и закрыт "
+                f"автоматически: окончание записано в {ended_at:%d.%m %H:%M}. "
+                f"Если это неверно, сообщите администратору.")
+        try:
+            await bot.send_message(chat_id=chat_id, text=text, rate_limit_args=LANE_BULK)
+        except (BadRequest, Forbidden) as e:
+            logger.warning("auto-close notice to employee %s dropped: %s", employee_id, e)
+        except Exception:
+            # the session is closed either way; the notice is not retried
+            logger.exception("auto-close notice to employee %s not sent", employee_id)
+
+
+def start(job_queue):
+    if AUTO_CLOSE_AFTER_HOURS:
+        job_queue.run_repeating(tick, interval=AUTO_CLOSE_INTERVAL_SECONDS, first=60, name="auto_close")
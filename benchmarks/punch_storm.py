@@ -0,0 +1,254 @@
+"""Shift-start load test of the real bot handlers.
+
+    python benchmarks/punch_storm.py --users 2000 --window 60
+
+Seeds --users employees in a "Нагрузочный тест" division of the configured
+database, builds the Application exactly as bot.py does and feeds it
+synthetic updates: every user presses "Начал" somewhere in the first
+--window seconds (most of them near the middle), then, after exponential
+think times, maybe "Коллеги", "Статистика", a break ("Отошел"/"Вернулся")
+and finally "Закончил". Replies go to a fake Bot API started here, which
+answers after --api-latency-ms.
+
+Latency is measured per update from the moment it is queued until all of
+its handlers are done, replies sent included. Telegram's outbound limits
+are off unless --telegram-limits is given, so the numbers are the bot's own.
+The seeded employees are deleted afterwards unless --keep is given.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+LOAD_TEST_NAME = "Нагрузочный тест"  # department and division
+FIRST_TELEGRAM_ID = 9_000_000_000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--window", type=float, default=60, help="seconds over which users press 'Начал'")
+    parser.add_argument("--think", type=float, default=5, help="mean seconds between a user's presses")
+    parser.add_argument("--api-latency-ms", type=float, default=30, help="fake Bot API response time")
+    parser.add_argument("--api-port", type=int, default=8181)
+    parser.add_argument("--concurrency", type=int, help="UPDATE_CONCURRENCY for this run")
+    parser.add_argument("--write-behind", action="store_true", help="run with PUNCH_WRITE_BEHIND on")
+    parser.add_argument("--telegram-limits", action="store_true", help="keep the outbound rate limits")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--keep", action="store_true", help="leave the seeded employees in the database")
+    return parser.parse_args()
+
+
+def configure(args):
+    # must run before config.py is imported
+    os.environ.setdefault("TELEGRAM_TOKEN", "0:loadtest")
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{args.api_port}/bot"
+    os.environ["TELEGRAM_FILE_URL"] = f"http://127.0.0.1:{args.api_port}/file/bot"
+    if args.concurrency:
+        os.environ["UPDATE_CONCURRENCY"] = str(args.concurrency)
+    if args.write_behind:
+        os.environ["PUNCH_WRITE_BEHIND"] = "1"
+    if not args.telegram_limits:
+        for name in ("OUTBOUND_GLOBAL_RATE", "OUTBOUND_CHAT_RATE", "OUTBOUND_GROUP_RATE"):
+            os.environ[name] = "0"
+
+
+def _serve_fake_api(port: int, latency: float, ready):
+    import tornado.web
+
+    message_ids = iter(range(1, 1 << 62))
+
+    class BotApi(tornado.web.RequestHandler):
+        async def post(self, token, method):
+            if latency:
+                await asyncio.sleep(latency)
+            if "json" in self.request.headers.get("Content-Type", ""):
+                data = json.loads(self.request.body or b"{}")
+            else:
+                data = {k: v[0].decode() for k, v in self.request.body_arguments.items()}
+            if method == "getMe":
+                result = {"id": 1, "is_bot": True, "first_name": "bot", "username": "bot"}
+            elif method in ("sendMessage", "editMessageText", "sendDocument"):
+                result = {"message_id": next(message_ids), "date": int(time.time()),
+                          "chat": {"id": int(data.get("chat_id") or 1), "type": "private"},
+                          "text": data.get("text", "")}
+            else:
+                result = True
+            self.write({"ok": True, "result": result})
+
+        get = post
+
+    async def serve():
+        tornado.web.Application([(r"/bot([^/]+)/(\w+)", BotApi)]).listen(port, "127.0.0.1")
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+def start_fake_api(port: int, latency: float):
+    # a process of its own, so that serving replies does not compete with the
+    # bot for the GIL and show up in its latencies
+    ready = multiprocessing.Event()
+    multiprocessing.Process(target=_serve_fake_api, args=(port, latency, ready),
+                            name="fake-bot-api", daemon=True).start()
+    ready.wait()
+
+
+def seed(users: int):
+    from database import connection
+    with connection() as conn:
+        # left over from an interrupted run
+        conn.run("DELETE FROM employees WHERE telegram_id >= %s;", (FIRST_TELEGRAM_ID,))
+        conn.run("DELETE FROM divisions WHERE name = %s;", (LOAD_TEST_NAME,))
+        conn.run("DELETE FROM departments WHERE name = %s;", (LOAD_TEST_NAME,))
+        dep_id = conn.run("INSERT INTO departments (name) VALUES (%s) RETURNING id;", (LOAD_TEST_NAME,))[0][0]
+        div_id = conn.run("INSERT INTO divisions (department_id, name) VALUES (%s, %s) RETURNING id;",
+                          (dep_id, LOAD_TEST_NAME))[0][0]
+        conn.run("""
+INSERT INTO employees (telegram_id, last_name, first_name, department_id, division_id)
+SELECT %s::bigint + g, 'Нагрузка', 'Сотрудник ' || g, %s, %s FROM generate_series(0, %s - 1) g;
+""", (FIRST_TELEGRAM_ID, dep_id, div_id, users))
+        conn.run("INSERT INTO online_status (employee_id, is_online) "
+                 "SELECT id, FALSE FROM employees WHERE telegram_id >= %s;", (FIRST_TELEGRAM_ID,))
+        conn.commit()
+
+
+def cleanup():
+    from database import connection
+    with connection() as conn:
+        conn.run("DELETE FROM daily_work_totals WHERE employee_id IN "
+                 "(SELECT id FROM employees WHERE telegram_id >= %s);", (FIRST_TELEGRAM_ID,))
+        conn.run("DELETE FROM employees WHERE telegram_id >= %s;", (FIRST_TELEGRAM_ID,))
+        conn.run("DELETE FROM divisions WHERE name = %s;", (LOAD_TEST_NAME,))
+        conn.run("DELETE FROM departments WHERE name = %s;", (LOAD_TEST_NAME,))
+        conn.commit()
+
+
+def plan(users: int, window: float, think: float, seed_value: int) -> list:
+    # (seconds from the start, telegram_id, button) for every press, in time order
+    rnd = random.Random(seed_value)
+    presses = []
+    for n in range(users):
+        tg = FIRST_TELEGRAM_ID + n
+        at = min(max(rnd.gauss(window / 2, window / 6), 0.0), window)
+        script = ["Начал"]
+        if rnd.random() < 0.3:
+            script.append("Коллеги")
+        if rnd.random() < 0.5:
+            script += ["Отошел", "Вернулся"]
+        if rnd.random() < 0.3:
+            script.append("Статистика")
+        script.append("Закончил")
+        for button in script:
+            presses.append((at, tg, button))
+            at += rnd.expovariate(1 / think) if think else 0.0
+    presses.sort()
+    return presses
+
+
+def percentile(values: list, q: float) -> float:
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run(args, presses: list) -> dict:
+    import bot
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    bot.load_caches()
+    app = bot.build_application()
+    queued = {}
+    latencies = defaultdict(list)
+    fed = asyncio.Event()
+    finished = asyncio.Event()
+
+    async def done(update, context):
+        # the last group: every handler for this update has returned
+        label, at = queued.pop(update.update_id)
+        latencies[label].append(time.perf_counter() - at)
+        if not queued and fed.is_set():
+            finished.set()
+
+    app.add_handler(TypeHandler(Update, done), group=1000)
+
+    await app.initialize()
+    await app.start()
+    started = time.perf_counter()
+    for update_id, (offset, tg, button) in enumerate(presses, 1):
+        delay = started + offset - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        update = Update.de_json({
+            "update_id": update_id,
+            "message": {"message_id": update_id, "date": int(time.time()), "text": button,
+                        "chat": {"id": tg, "type": "private"},
+                        "from": {"id": tg, "is_bot": False, "first_name": "Сотрудник"}},
+        }, app.bot)
+        queued[update_id] = (button, time.perf_counter())
+        await app.update_queue.put(update)
+    fed.set()
+    if queued:
+        await finished.wait()
+    elapsed = time.perf_counter() - started
+
+    await app.stop()
+    await app.shutdown()
+    await bot.on_shutdown(app)
+    return {"elapsed": elapsed, "latencies": latencies}
+
+
+def report(args, elapsed: float, latencies: dict) -> dict:
+    rows = {}
+    everything = sorted(v for values in latencies.values() for v in values)
+    for label, values in sorted(latencies.items()) + [("всего", everything)]:
+        values = sorted(values)
+        rows[label] = {
+            "count": len(values),
+            "per_second": len(values) / elapsed,
+            "p50_ms": percentile(values, 0.50) * 1000,
+            "p95_ms": percentile(values, 0.95) * 1000,
+            "p99_ms": percentile(values, 0.99) * 1000,
+            "max_ms": values[-1] * 1000,
+        }
+    print(f"{args.users} users, {len(everything)} updates in {elapsed:.1f}s")
+    print(f"{'':<12}{'count':>8}{'upd/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for label, r in rows.items():
+        print(f"{label:<12}{r['count']:>8}{r['per_second']:>9.1f}"
+              f"{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['p99_ms']:>10.1f}{r['max_ms']:>10.1f}")
+    return rows
+
+
+def main():
+    args = parse_args()
+    configure(args)
+    from config import DB_MIGRATE_ON_START
+    from migrations import migrate
+
+    start_fake_api(args.api_port, args.api_latency_ms / 1000)
+    if DB_MIGRATE_ON_START:
+        migrate()
+    seed(args.users)
+    try:
+        presses = plan(args.users, args.window, args.think, args.seed)
+        result = asyncio.run(run(args, presses))
+        rows = report(args, result["elapsed"], result["latencies"])
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"args": vars(args), "elapsed": result["elapsed"], "handlers": rows},
+                          f, ensure_ascii=False, indent=2)
+    finally:
+        if not args.keep:
+            cleanup()
+
+
+if __name__ == "__main__":
+    main()
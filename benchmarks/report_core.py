@@ -0,0 +1,105 @@
+"""Cost of the report core on synthetic data, without a database.
+
+    python benchmarks/report_core.py --employees 10000 --days 22
+
+Both sides start from the same employee-day rows. The old path is the
+per-row loop that accumulated them per employee and formatted the totals.
+The new path sums them the way SELECT_DIVISION_REPORT's GROUP BY does (here a
+Python stand-in) and formats the totals with render_text_report, still one
+line per employee; the last line times that formatting alone. In Python the
+two cost about the same: the report gets faster because the database returns
+one row per employee instead of every day row, which this does not measure.
+Time the queries with EXPLAIN ANALYZE on real data.
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from reporting import format_hours_minutes, render_excel_report, render_text_report  # noqa: E402
+
+
+def make_days(employees: int, days: int, seed: int = 1) -> list:
+    rnd = random.Random(seed)
+    start = datetime.date(2025, 1, 1)
+    rows = []
+    for eid in range(1, employees + 1):
+        name = f"Сотрудник{eid:06d} Тест"
+        for d in range(days):
+            sessions = 0 if rnd.random() < 0.1 else 1
+            worked = rnd.uniform(6, 10) * 3600 if sessions else 0.0
+            overtime = max(0.0, worked - 8 * 3600)
+            rows.append((eid, name, overtime, start + datetime.timedelta(days=d),
+                         worked, rnd.uniform(0, 3600), sessions))
+    return rows
+
+
+def make_totals(days: list) -> list:
+    # what SELECT_DIVISION_REPORT returns for the same rows
+    totals = {}
+    for eid, full_name, overtime, day, worked, breaks, sessions in days:
+        if sessions:
+            item = totals.setdefault(eid, [eid, full_name, 0, 0.0, 0.0])
+            item[2] += 1
+            item[3] += worked
+            item[4] += overtime
+    return sorted((tuple(item) for item in totals.values()), key=lambda r: (r[1], r[0]))
+
+
+def per_row_text(days: list, start_date, end_date) -> str:
+    # the loop over day rows: Python accumulation and formatting per row
+    totals = {}
+    for eid, full_name, overtime, day, worked, breaks, sessions in days:
+        item = totals.setdefault(eid, [full_name, 0.0, 0.0, 0])
+        if sessions:
+            item[1] += worked
+            item[2] += overtime
+            item[3] += 1
+    lines = [f"Отчёт за период {start_date} — {end_date}:"]
+    for name, secs, overtime, shifts in sorted(totals.values()):
+        if not shifts:
+            continue
+        lines.append(
+            f"{name}: дней: {shifts}, общее: {format_hours_minutes(secs)}, "
+            f"ср. в день: {format_hours_minutes(secs / shifts)}, "
+            f"overtime: {format_hours_minutes(overtime)}"
+        )
+    return "\n".join(lines)
+
+
+def timed(label: str, func, *args, repeat: int = 3):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - started)
+    print(f"{label:<28} {best * 1000:10.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--employees", type=int, default=10000)
+    parser.add_argument("--days", type=int, default=22)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--excel", action="store_true", help="also time the xlsx renderer")
+    args = parser.parse_args()
+
+    days = make_days(args.employees, args.days)
+    totals = make_totals(days)
+    start, end = days[0][3], days[-1][3]
+    print(f"{args.employees} employees x {args.days} days = {len(days)} rows")
+    timed("per-row loop (text)", per_row_text, days, start, end, repeat=args.repeat)
+    timed("sum + render_text_report", lambda: render_text_report(make_totals(days), start, end),
+          repeat=args.repeat)
+    timed("render_text_report only", render_text_report, totals, start, end, repeat=args.repeat)
+    if args.excel:
+        detail = [(name, day, worked, breaks, sessions) for _, name, _, day, worked, breaks, sessions in days]
+        timed("render_excel_report", lambda: render_excel_report(totals, detail).close(), repeat=1)
+
+
+if __name__ == "__main__":
+    main()
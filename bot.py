@@ -1,18 +1,77 @@
+import logging
 from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler
-from config import TELEGRAM_TOKEN
-from handlers.registration import registration_handler
+from config import (
+    TELEGRAM_TOKEN, TELEGRAM_API_URL, TELEGRAM_FILE_URL, DB_MIGRATE_ON_START, EVENTS_LISTEN,
+    BOT_MODE, UPDATE_CONCURRENCY, PERSISTENCE_ENABLED, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL, WEBHOOK_SECRET,
+    LOG_LEVEL, METRICS_LISTEN, METRICS_PORT, METRICS_LOG_SECONDS, QUERY_PROFILE,
+)
+from migrations import migrate
+import events
+import metrics
+import query_profile
+from models import (
+    rebuild_presence, resync_caches, apply_employee_event, apply_presence_event, apply_reports_event,
+)
+import report_jobs
+import reminder_scheduler
+import auto_close
+from rate_limiter import OutboundLimiter
+from application import OrderedApplication
+from persistence import PostgresPersistence
+from handlers.identity import identity_handler
+from handlers.registration import registration_handler, reload_directory
 from handlers.work import menu, start_work_cb, end_work_cb, start_break_cb, end_break_cb
-from handlers.colleagues import colleagues_cb
+from handlers.colleagues import colleagues_cb, colleagues_page_cb
 from handlers.stats import stats_cb
+from handlers.slow_queries import slow_queries_cmd
 from handlers.admin import admin_menu, admin_handler
 from handlers.reminders import reminders_handler, REMINDER_STATES, reminders_callback  # новый
 from handlers.reports import reports_handler, REPORT_STATES  # новый
 
+async def on_shutdown(app):
+    events.stop()
+    metrics.stop_server()
+    report_jobs.shutdown()
+
 async def unknown(update, context):
     await update.message.reply_text("Извините, я не понимаю команду. Используйте /start, чтобы зарегистрироваться, или кнопку меню.")
 
-def main():
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+def load_caches():
+    if EVENTS_LISTEN:
+        # other bot processes' changes reach the caches as they commit
+        events.subscribe(events.EMPLOYEE, apply_employee_event)
+        events.subscribe(events.PRESENCE, apply_presence_event)
+        events.subscribe(events.REPORTS, apply_reports_event)
+        events.subscribe(events.DIRECTORY, lambda event: reload_directory())
+        events.on_resync(reload_directory)
+        events.on_resync(resync_caches)
+        events.start()
+    else:
+        reload_directory()
+        rebuild_presence()
+
+def build_application():
+    limiter = OutboundLimiter()
+    metrics.add_collector(limiter.collect)
+    builder = (
+        ApplicationBuilder()
+        .application_class(OrderedApplication)
+        .token(TELEGRAM_TOKEN)
+        .base_url(TELEGRAM_API_URL)
+        .base_file_url(TELEGRAM_FILE_URL)
+        .rate_limiter(limiter)
+        .concurrent_updates(UPDATE_CONCURRENCY)
+        .post_shutdown(on_shutdown)
+    )
+    if PERSISTENCE_ENABLED:
+        # conversations and user_data survive restarts
+        builder = builder.persistence(PostgresPersistence())
+    app = builder.build()
+    reminder_scheduler.start(app.job_queue)
+    auto_close.start(app.job_queue)
+    if METRICS_LOG_SECONDS:
+        app.job_queue.run_repeating(metrics.log_job, interval=METRICS_LOG_SECONDS, name="metrics")
+    app.add_handler(identity_handler(), group=-1)
     app.add_handler(registration_handler())
     app.add_handler(CommandHandler("menu", menu))
 
@@ -22,6 +81,7 @@ def main():
     app.add_handler(MessageHandler(ext_filters.Regex("^Отошел$"), start_break_cb))
     app.add_handler(MessageHandler(ext_filters.Regex("^Вернулся$"), end_break_cb))
     app.add_handler(MessageHandler(ext_filters.Regex("^Коллеги$"), colleagues_cb))
+    app.add_handler(CallbackQueryHandler(colleagues_page_cb, pattern=r"^colleagues_page_\d+$"))
     app.add_handler(MessageHandler(ext_filters.Regex("^Статистика$"), stats_cb))
     app.add_handler(MessageHandler(ext_filters.Regex("^Напоминания$"), reminders_callback))
     app.add_handler(reminders_handler())
@@ -29,17 +89,45 @@ def main():
     app.add_handler(CallbackQueryHandler(admin_menu, pattern="^menu_admin$"))
     app.add_handler(admin_handler())
     app.add_handler(reports_handler())
+    app.add_handler(CommandHandler("slow_queries", slow_queries_cmd))
 
     from telegram.ext import MessageHandler, filters as ext_filters
     app.add_handler(MessageHandler(ext_filters.COMMAND, unknown))
+    return app
 
-    app.run_polling()
+def main():
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s", level=LOG_LEVEL)
+    # httpx logs every Bot API request at INFO
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    if QUERY_PROFILE:
+        query_profile.enable()
+    if DB_MIGRATE_ON_START:
+        migrate()
+    load_caches()
+    app = build_application()
+    if METRICS_PORT:
+        metrics.start_server(METRICS_LISTEN, METRICS_PORT)
+    if BOT_MODE == "webhook":
+        # without WEBHOOK_URL Telegram is told to post to http://WEBHOOK_LISTEN:WEBHOOK_PORT/WEBHOOK_PATH,
+        # which is enough for a local Bot API server or the tests; in production
+        # TLS usually ends at a reverse proxy in front of this plain HTTP listener
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=UPDATE_CONCURRENCY,
+        )
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
 
 
 #pip install -r requirements.txt
+#python manage.py migrate   (или DB_MIGRATE_ON_START=1)
 #python bot.py
 
 
@@ -0,0 +1,125 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # Every pop and clear advances the generation. A value read from the
+        # database is only stored if its key was not popped since the
+        # generation taken before the read, see set(). Keys popped longer ago
+        # than the last maxsize pops are covered by _floor.
+        self._generation = 0
+        self._popped = OrderedDict()  # key -> generation of its last pop
+        self._floor = 0
+
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, generation: int = None):
+        with self._lock:
+            if generation is not None and (generation < self._floor or self._popped.get(key, 0) > generation):
+                # invalidated while the value was being read
+                return
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            self._generation += 1
+            self._popped[key] = self._generation
+            self._popped.move_to_end(key)
+            if len(self._popped) > self.maxsize:
+                self._floor = self._popped.popitem(last=False)[1]
+        return default if item is None else item[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._generation += 1
+            self._popped.clear()
+            self._floor = self._generation
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SizedCache:
+    # LRU bounded by the total size of its values rather than their count;
+    # a value over maxitem bytes is not stored
+    def __init__(self, maxbytes: int, ttl: float, sizeof=len, maxitem: int = None):
+        self.maxbytes = maxbytes
+        self.maxitem = min(maxbytes, maxitem) if maxitem else maxbytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remove(self, key):
+        value, size, expires = self._data.pop(key)
+        self.size -= size
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, size, expires = item
+            if expires < time.monotonic():
+                self._remove(key)
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            if size > self.maxitem:
+                return
+            self._data[key] = (value, size, time.monotonic() + self.ttl)
+            self.size += size
+            while self.size > self.maxbytes:
+                self._remove(next(iter(self._data)))
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            value = self._data[key][0]
+            self._remove(key)
+        return value
+
+    def discard_where(self, predicate):
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._data)
@@ -3,10 +3,116 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+
+def _flag(name: str, default: bool) -> bool:
+    return os.getenv(name, str(default)).strip().lower() in ("1", "true", "yes", "on")
+
+
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+# point these at a local fake Bot API to test without Telegram
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+TELEGRAM_FILE_URL = os.getenv("TELEGRAM_FILE_URL", "https://api.telegram.org/file/bot")
+
+# "polling" or "webhook"; the webhook listener speaks plain HTTP
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# updates handled at once; each user's updates still go one by one
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 32))
+
+# conversation state and user_data kept in Postgres, see persistence.py;
+# changes are written in batches at most PERSISTENCE_FLUSH_SECONDS apart
+PERSISTENCE_ENABLED = _flag("PERSISTENCE_ENABLED", True)
+PERSISTENCE_UPDATE_SECONDS = float(os.getenv("PERSISTENCE_UPDATE_SECONDS", 5))
+PERSISTENCE_FLUSH_SECONDS = float(os.getenv("PERSISTENCE_FLUSH_SECONDS", 1))
 
 DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_PORT = int(os.getenv("DB_PORT", 5432))
 DB_NAME = os.getenv("DB_NAME")
 DB_USER = os.getenv("DB_USER")
 DB_PASS = os.getenv("DB_PASS")
+
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", 300))
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", 3600))
+DB_POOL_CHECK_AFTER = float(os.getenv("DB_POOL_CHECK_AFTER", 30))
+DB_MIGRATE_ON_START = _flag("DB_MIGRATE_ON_START", True)
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", 0))
+
+EMPLOYEE_CACHE_SIZE = int(os.getenv("EMPLOYEE_CACHE_SIZE", 10000))
+# with EVENTS_LISTEN on, changes are applied as they happen and the TTL is
+# only a backstop
+EMPLOYEE_CACHE_TTL = float(os.getenv("EMPLOYEE_CACHE_TTL", 3600))
+
+PUNCH_DEBOUNCE_SECONDS = float(os.getenv("PUNCH_DEBOUNCE_SECONDS", 3))
+# group commit for punches: presses arriving within PUNCH_BATCH_DELAY_MS of
+# each other share one transaction, see punches.py. It only pays off at much
+# higher load than ours: with benchmarks/punch_storm.py at 1000 users (~40
+# updates/s) it gains nothing, and a 5 ms delay raised p50 from 43 to 50 ms.
+# Only once the bot was saturated (3000 users in 30 s) did it help, with
+# 157-163 instead of 145 updates/s. Presses queued while a batch is written
+# are grouped even without a delay, hence 0 by default.
+PUNCH_WRITE_BEHIND = _flag("PUNCH_WRITE_BEHIND", False)
+PUNCH_BATCH_DELAY_MS = float(os.getenv("PUNCH_BATCH_DELAY_MS", 0))
+PUNCH_BATCH_MAX = int(os.getenv("PUNCH_BATCH_MAX", 500))
+STATS_CACHE_SIZE = int(os.getenv("STATS_CACHE_SIZE", 10000))
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", 3600))
+
+REPORT_FETCH_SIZE = int(os.getenv("REPORT_FETCH_SIZE", 2000))
+REPORT_SPOOL_MAX_BYTES = int(os.getenv("REPORT_SPOOL_MAX_BYTES", 8 * 1024 * 1024))
+REPORT_DETAIL_SHEET = _flag("REPORT_DETAIL_SHEET", True)
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", 2))
+REPORT_CACHE_MAX_BYTES = int(os.getenv("REPORT_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+# a single report or set of totals larger than this is not cached at all
+REPORT_CACHE_ITEM_MAX_BYTES = int(os.getenv("REPORT_CACHE_ITEM_MAX_BYTES", 4 * 1024 * 1024))
+REPORT_CACHE_TTL = float(os.getenv("REPORT_CACHE_TTL", 24 * 3600))
+
+# cache invalidation between bot processes over LISTEN/NOTIFY, see events.py
+EVENTS_LISTEN = _flag("EVENTS_LISTEN", True)
+EVENTS_POLL_SECONDS = float(os.getenv("EVENTS_POLL_SECONDS", 1))
+EVENTS_RECONNECT_SECONDS = float(os.getenv("EVENTS_RECONNECT_SECONDS", 5))
+
+COLLEAGUES_PAGE_SIZE = int(os.getenv("COLLEAGUES_PAGE_SIZE", 50))
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+
+# Prometheus text on http://METRICS_LISTEN:METRICS_PORT/metrics (0 turns it
+# off) and a log summary every METRICS_LOG_SECONDS (0 turns it off)
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9464))
+METRICS_LOG_SECONDS = float(os.getenv("METRICS_LOG_SECONDS", 300))
+
+# opt-in slow-query profiling, see query_profile.py; /slow_queries shows the
+# statements with the most total time
+QUERY_PROFILE = _flag("QUERY_PROFILE", False)
+QUERY_PROFILE_SLOW_MS = float(os.getenv("QUERY_PROFILE_SLOW_MS", 100))
+QUERY_PROFILE_LOG = os.getenv("QUERY_PROFILE_LOG", "slow_queries.jsonl")
+QUERY_PROFILE_EXPLAIN_SECONDS = float(os.getenv("QUERY_PROFILE_EXPLAIN_SECONDS", 600))
+QUERY_PROFILE_EXPLAIN_TIMEOUT_MS = float(os.getenv("QUERY_PROFILE_EXPLAIN_TIMEOUT_MS", 30000))
+
+REMINDER_TICK_SECONDS = float(os.getenv("REMINDER_TICK_SECONDS", 1))
+REMINDER_WINDOW_SECONDS = float(os.getenv("REMINDER_WINDOW_SECONDS", 600))
+REMINDER_REFILL_SECONDS = float(os.getenv("REMINDER_REFILL_SECONDS", 60))
+REMINDER_BATCH_SIZE = int(os.getenv("REMINDER_BATCH_SIZE", 1000))
+
+# sessions still open this many hours after they started are closed by
+# auto_close.py, at most AUTO_CLOSE_BATCH of them every AUTO_CLOSE_INTERVAL_SECONDS;
+# 0 hours turns it off
+AUTO_CLOSE_AFTER_HOURS = float(os.getenv("AUTO_CLOSE_AFTER_HOURS", 16))
+AUTO_CLOSE_INTERVAL_SECONDS = float(os.getenv("AUTO_CLOSE_INTERVAL_SECONDS", 600))
+AUTO_CLOSE_BATCH = int(os.getenv("AUTO_CLOSE_BATCH", 5000))
+
+# Telegram allows about 30 messages a second overall, one a second per private
+# chat and 20 a minute per group; 0 turns a limit off
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", 30))
+OUTBOUND_GLOBAL_BURST = float(os.getenv("OUTBOUND_GLOBAL_BURST", 10))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", 1))
+OUTBOUND_CHAT_BURST = float(os.getenv("OUTBOUND_CHAT_BURST", 3))
+OUTBOUND_GROUP_RATE = float(os.getenv("OUTBOUND_GROUP_RATE", 20 / 60))
+OUTBOUND_GROUP_BURST = float(os.getenv("OUTBOUND_GROUP_BURST", 20))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", 3))
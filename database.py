@@ -1,7 +1,74 @@
+import asyncio
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
 import pg8000
-from config import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASS
+import metrics
+from config import (
+    DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASS,
+    DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_MAX_IDLE, DB_POOL_MAX_LIFETIME, DB_POOL_CHECK_AFTER,
+    DB_EXECUTOR_WORKERS,
+)
+
+_PLACEHOLDER = re.compile(r"%s")
+_SPACE = re.compile(r"\s+")
+
+# SQL text -> the label its timings are recorded under
+_statement_labels = {}
+
+
+def name_statements(namespace: dict):
+    # labels statements with the names of the module constants holding them,
+    # e.g. name_statements(globals()) at the end of models.py
+    for name, value in namespace.items():
+        if name.isupper() and isinstance(value, str):
+            _statement_labels[value] = name
+
+
+def statement_label(sql: str) -> str:
+    label = _statement_labels.get(sql)
+    if label is None:
+        # unnamed statements are few and fixed; their opening words will do
+        label = _statement_labels[sql] = _SPACE.sub(" ", sql).strip()[:60]
+    return label
+
+
+# hook(sql, params, seconds) runs after every timed statement, on the thread
+# that ran it; see query_profile.py
+_query_hooks = []
+
+
+def add_query_hook(hook):
+    _query_hooks.append(hook)
+
+
+def observe_statement(sql: str, params, seconds: float, error: bool = False):
+    metrics.QUERIES.observe(statement_label(sql), seconds, error)
+    for hook in _query_hooks:
+        hook(sql, params, seconds)
+
+
+@contextmanager
+def timed_statement(sql: str, params=()):
+    # for statements run through a cursor rather than PooledConnection.run
+    started = time.perf_counter()
+    error = True
+    try:
+        yield
+        error = False
+    finally:
+        observe_statement(sql, params, time.perf_counter() - started, error)
 
-def get_conn():
+
+class PoolTimeout(Exception):
+    pass
+
+
+def connect():
+    # a plain connection outside the pool, for long-lived uses like LISTEN
     return pg8000.connect(
         host=DB_HOST,
         port=DB_PORT,
@@ -10,5 +77,236 @@ def get_conn():
         password=DB_PASS,
     )
 
-def release_conn(conn):
-    conn.close()
+
+def _to_named(sql: str) -> str:
+    # pg8000 prepared statements use :name placeholders, models.py uses %s
+    counter = iter(range(sql.count("%s")))
+    return _PLACEHOLDER.sub(lambda _: f":p{next(counter)}", sql)
+
+
+class PooledConnection:
+    def __init__(self, raw):
+        self.raw = raw
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self._prepared = {}
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+    def run(self, sql: str, params=()):
+        # prepared once per connection, then only Bind/Execute on reuse
+        started = time.perf_counter()
+        error = True
+        try:
+            ps = self._prepared.get(sql)
+            if ps is None:
+                ps = self.raw.prepare(_to_named(sql))
+                self._prepared[sql] = ps
+            rows = ps.run(**{f"p{i}": value for i, value in enumerate(params)})
+            error = False
+            return rows
+        finally:
+            observe_statement(sql, params, time.perf_counter() - started, error)
+
+    def ping(self) -> bool:
+        autocommit = self.raw.autocommit
+        try:
+            self.raw.autocommit = True
+            self.raw.run("SELECT 1")
+            return True
+        except Exception:
+            return False
+        finally:
+            self.raw.autocommit = autocommit
+
+    def close(self):
+        try:
+            self.raw.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    def __init__(self, minconn: int, maxconn: int, timeout: float,
+                 max_idle: float, max_lifetime: float, check_after: float):
+        self.minconn = minconn
+        self.maxconn = max(maxconn, 1)
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.check_after = check_after
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def _connect(self) -> PooledConnection:
+        return PooledConnection(connect())
+
+    def _expired(self, conn: PooledConnection, now: float) -> bool:
+        return self.max_lifetime and now - conn.created_at > self.max_lifetime
+
+    def _recycle_idle(self, now: float):
+        # the idle list is ordered oldest-release first
+        while self._idle and self._size > self.minconn:
+            conn = self._idle[0]
+            if now - conn.last_used <= self.max_idle and not self._expired(conn, now):
+                break
+            self._idle.pop(0)
+            self._size -= 1
+            conn.close()
+
+    def getconn(self) -> PooledConnection:
+        with metrics.timer(metrics.POOL_WAIT):
+            return self._getconn()
+
+    def _getconn(self) -> PooledConnection:
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                self._recycle_idle(now)
+                conn = None
+                if self._idle:
+                    conn = self._idle.pop()
+                elif self._size < self.maxconn:
+                    self._size += 1
+                else:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise PoolTimeout(f"no free database connection after {self.timeout}s")
+                    self._cond.wait(remaining)
+                    continue
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    self._discard_slot()
+                    raise
+                return conn
+
+            now = time.monotonic()
+            if self._expired(conn, now) or (
+                    now - conn.last_used > self.check_after and not conn.ping()):
+                conn.close()
+                self._discard_slot()
+                continue
+            return conn
+
+    def putconn(self, conn: PooledConnection, discard: bool = False):
+        if not discard:
+            try:
+                if conn.raw._in_transaction:
+                    conn.raw.rollback()
+                conn.raw.autocommit = False
+            except Exception:
+                discard = True
+        if discard:
+            conn.close()
+            self._discard_slot()
+            return
+        with self._cond:
+            conn.last_used = time.monotonic()
+            self._idle.append(conn)
+            self._cond.notify()
+
+    def _discard_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def fill(self):
+        conns = [self.getconn() for _ in range(self.minconn)]
+        for conn in conns:
+            self.putconn(conn)
+
+    def collect(self):
+        with self._cond:
+            size, idle = self._size, len(self._idle)
+        return [
+            ("bot_db_pool_connections", "gauge", "Open pooled connections", [({}, size)]),
+            ("bot_db_pool_idle_connections", "gauge", "Pooled connections not checked out", [({}, idle)]),
+        ]
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for conn in idle:
+            conn.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                pool = ConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT,
+                                      DB_POOL_MAX_IDLE, DB_POOL_MAX_LIFETIME, DB_POOL_CHECK_AFTER)
+                pool.fill()
+                metrics.add_collector(pool.collect)
+                _pool = pool
+    return _pool
+
+
+def get_conn() -> PooledConnection:
+    return get_pool().getconn()
+
+
+def release_conn(conn, discard: bool = False):
+    get_pool().putconn(conn, discard)
+
+
+@contextmanager
+def connection(autocommit: bool = False):
+    conn = get_conn()
+    discard = False
+    try:
+        conn.raw.autocommit = autocommit
+        yield conn
+    except pg8000.InterfaceError:
+        discard = True
+        raise
+    finally:
+        release_conn(conn, discard)
+
+
+def stream(conn, sql: str, params=(), chunk_size: int = 1000):
+    # pg8000 buffers whole result sets, so large reads go through a server-side
+    # cursor and arrive chunk_size rows at a time; needs an open transaction
+    cur = conn.cursor()
+    with timed_statement(sql, params):
+        cur.execute(f"DECLARE stream_cur NO SCROLL CURSOR FOR {sql.strip().rstrip(';')}", params)
+    try:
+        while True:
+            # each chunk is timed on its own, under the streamed statement
+            with timed_statement(sql, params):
+                cur.execute(f"FETCH {int(chunk_size)} FROM stream_cur")
+                rows = cur.fetchall()
+            if not rows:
+                break
+            yield from rows
+    except GeneratorExit:
+        cur.execute("CLOSE stream_cur")
+        raise
+    cur.execute("CLOSE stream_cur")
+
+
+# pg8000 is blocking, so handlers reach the database through a bounded thread
+# pool; by default it has one thread per pooled connection.
+_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS or DB_POOL_MAX, thread_name_prefix="db")
+
+
+def _timed_call(queued: float, func, args, kwargs):
+    metrics.EXECUTOR_WAIT.observe(None, time.perf_counter() - queued)
+    return func(*args, **kwargs)
+
+
+async def run_db(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, _timed_call, time.perf_counter(), func, args, kwargs)
@@ -0,0 +1,132 @@
+import json
+import logging
+import select
+import threading
+from collections import defaultdict, deque
+
+from config import EVENTS_POLL_SECONDS, EVENTS_RECONNECT_SECONDS
+from database import connect
+
+logger = logging.getLogger(__name__)
+
+# Changes to employees, online_status and the department directory are
+# announced by triggers (migration 7) on this channel, as JSON with a "kind";
+# other changes are announced with publish(). Every bot process listens and
+# applies them to its own caches, its own changes included.
+CHANNEL = "bot_events"
+
+EMPLOYEE = "employee"    # id, telegram_id
+PRESENCE = "presence"    # employee_id, online, session_closed
+DIRECTORY = "directory"
+REPORTS = "reports"      # department_id, division_id; both null for all
+
+_handlers = defaultdict(list)
+_resync_handlers = []
+_listener = None
+
+
+def subscribe(kind: str, handler):
+    # handler(payload: dict) runs on the listener thread
+    _handlers[kind].append(handler)
+
+
+def on_resync(handler):
+    # handler() runs whenever the listener (re)connects, since anything
+    # announced while it was away is lost
+    _resync_handlers.append(handler)
+
+
+def publish(conn, kind: str, **data):
+    # delivered when conn's transaction commits, and not at all on rollback
+    conn.run("SELECT pg_notify(%s, %s);", (CHANNEL, json.dumps({"kind": kind, **data})))
+
+
+def _dispatch(payload: str):
+    try:
+        event = json.loads(payload)
+    except ValueError:
+        logger.warning("malformed event %r", payload)
+        return
+    for handler in _handlers.get(event.get("kind"), ()):
+        try:
+            handler(event)
+        except Exception:
+            logger.exception("event handler failed for %r", event)
+
+
+def _resync():
+    for handler in _resync_handlers:
+        try:
+            handler()
+        except Exception:
+            logger.exception("resync handler failed")
+
+
+class Listener(threading.Thread):
+    def __init__(self):
+        super().__init__(name="events", daemon=True)
+        self._stopped = threading.Event()
+        self.ready = threading.Event()
+        self.error = None
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self._listen()
+            except Exception as e:
+                if not self.ready.is_set():
+                    self.error = e
+                    self.ready.set()
+                    return
+                logger.exception("event listener lost its connection, reconnecting in %ss", EVENTS_RECONNECT_SECONDS)
+                self._stopped.wait(EVENTS_RECONNECT_SECONDS)
+
+    def _listen(self):
+        conn = connect()
+        try:
+            conn.autocommit = True
+            # pg8000 keeps only the last 100 by default
+            conn.notifications = deque()
+            conn.run(f"LISTEN {CHANNEL}")
+            _resync()
+            self.ready.set()
+            sock = getattr(conn, "_usock", None)
+            while not self._stopped.is_set():
+                # pg8000 only reads notifications while running a statement,
+                # so wait for the socket and then run a trivial one
+                if sock is not None:
+                    select.select([sock], [], [], EVENTS_POLL_SECONDS)
+                else:
+                    self._stopped.wait(EVENTS_POLL_SECONDS)
+                conn.run("SELECT 1")
+                while conn.notifications:
+                    _pid, _channel, payload = conn.notifications.popleft()
+                    _dispatch(payload)
+        finally:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+def start():
+    # returns once the resync handlers have run on the listener thread, so
+    # they can do the initial cache loads without racing the first events
+    global _listener
+    if _listener is None:
+        listener = Listener()
+        listener.start()
+        listener.ready.wait()
+        if listener.error is not None:
+            raise listener.error
+        _listener = listener
+
+
+def stop():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
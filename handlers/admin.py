@@ -1,8 +1,9 @@
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes, CallbackQueryHandler, ConversationHandler, MessageHandler, filters
-from database import get_conn, release_conn
+from config import PERSISTENCE_ENABLED
+from database import run_db
 from handlers.registration import DEPS, DIVS
-from models import set_employee_role, get_employee_by_telegram
+from models import set_employee_role, list_employees
 
 (
     CHOOSING_DEP,
@@ -13,11 +14,6 @@ from models import set_employee_role, get_employee_by_telegram
 ) = range(5)
 
 
-from handlers.registration import DEPS, DIVS
-
-promote_data = {}
-action_type = None
-
 async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     kb = InlineKeyboardMarkup([
         [InlineKeyboardButton("Дать админ", callback_data="admin_promote")],
@@ -27,8 +23,7 @@ async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.edit_message_text("Выберите действие администратора:", reply_markup=kb)
 
 async def start_promote_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global action_type
-    action_type = 'promote'
+    context.user_data['admin_action'] = 'promote'
     kb = InlineKeyboardMarkup([[InlineKeyboardButton(name, callback_data=name)] for name in DEPS.keys()])
     prompt = "Выберите департамент:"
     if update.callback_query:
@@ -38,8 +33,7 @@ async def start_promote_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return CHOOSING_DEP
 
 async def start_delete_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global action_type
-    action_type = 'delete'
+    context.user_data['admin_action'] = 'delete'
     kb = InlineKeyboardMarkup([[InlineKeyboardButton(name, callback_data=name)] for name in DEPS.keys()])
     prompt = "Выберите департамент:"
     if update.callback_query:
@@ -50,28 +44,22 @@ async def start_delete_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def choose_dep(update: Update, context: ContextTypes.DEFAULT_TYPE):
     dep = update.callback_query.data
-    promote_data['dep_id'] = DEPS[dep]
-    kb = InlineKeyboardMarkup([[InlineKeyboardButton(name, callback_data=name)] for name in DIVS[promote_data['dep_id']].keys()])
+    context.user_data['admin_dep_id'] = DEPS[dep]
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton(name, callback_data=name)] for name in DIVS[DEPS[dep]].keys()])
     await update.callback_query.edit_message_text("Выберите отдел:", reply_markup=kb)
     return CHOOSING_DIV
 
 async def choose_div(update: Update, context: ContextTypes.DEFAULT_TYPE):
     div = update.callback_query.data
-    promote_data['div_id'] = DIVS[promote_data['dep_id']][div]
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("""
-        SELECT id, last_name || ' ' || first_name FROM employees
-        WHERE department_id=%s AND division_id=%s;
-    """, (promote_data['dep_id'], promote_data['div_id']))
-    rows = cur.fetchall()
-    release_conn(conn)
+    dep_id = context.user_data['admin_dep_id']
+    rows = await run_db(list_employees, dep_id, DIVS[dep_id][div])
     kb = InlineKeyboardMarkup([[InlineKeyboardButton(txt, callback_data=str(emp_id))] for emp_id, txt in rows])
     await update.callback_query.edit_message_text("Выберите сотрудника:", reply_markup=kb)
     return CHOOSING_EMP
 
 async def choose_emp(update: Update, context: ContextTypes.DEFAULT_TYPE):
     emp_id = int(update.callback_query.data)
-    promote_data['emp_id'] = emp_id
+    context.user_data['admin_emp_id'] = emp_id
     text = "Подтвердите действие:"
     kb = InlineKeyboardMarkup([[
         InlineKeyboardButton("Да", callback_data="yes"),
@@ -86,12 +74,9 @@ async def confirm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.callback_query.edit_message_text("Операция отменена.")
         return ConversationHandler.END
 
-    conn = get_conn(); cur = conn.cursor()
-    if action_type == 'promote':
-        cur.execute("UPDATE employees SET role='admin' WHERE id=%s;", (promote_data['emp_id'],))
-    else:
-        cur.execute("UPDATE employees SET role='worker' WHERE id=%s;", (promote_data['emp_id'],))
-    conn.commit(); release_conn(conn)
+    action_type = context.user_data.get('admin_action')
+    role = 'admin' if action_type == 'promote' else 'worker'
+    await run_db(set_employee_role, context.user_data['admin_emp_id'], role)
 
     msg = "Права изменены." if action_type=='promote' else "Админ снят."
     await update.callback_query.edit_message_text(msg)
@@ -111,5 +96,7 @@ def admin_handler():
             CHOOSING_EMP: [CallbackQueryHandler(choose_emp)],
             CONFIRM_PROMOTE: [CallbackQueryHandler(confirm_cb, pattern="^(yes|no)$")],
         },
-        fallbacks=[]
+        fallbacks=[],
+        name="admin",
+        persistent=PERSISTENCE_ENABLED,
     )
@@ -1,22 +1,43 @@
-from telegram import Update
+from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes, CallbackQueryHandler
-from database import get_conn, release_conn
+from config import COLLEAGUES_PAGE_SIZE
+import presence
+
+
+def _colleagues_page(emp, page: int):
+    names, total = presence.online_page(emp.department_id, emp.division_id, page, COLLEAGUES_PAGE_SIZE)
+    if not total:
+        return "Сейчас никто из ваших коллег не в сети.", None
+    pages = (total + COLLEAGUES_PAGE_SIZE - 1) // COLLEAGUES_PAGE_SIZE
+    page = min(page, pages - 1)
+    if not names:
+        names, total = presence.online_page(emp.department_id, emp.division_id, page, COLLEAGUES_PAGE_SIZE)
+    text = "Коллеги в сети:\n" + "\n".join(names)
+    if pages == 1:
+        return text, None
+    text += f"\n\nСтраница {page + 1} из {pages}, всего {total}"
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀", callback_data=f"colleagues_page_{page - 1}"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton("▶", callback_data=f"colleagues_page_{page + 1}"))
+    return text, InlineKeyboardMarkup([buttons])
+
 
 async def colleagues_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.message.from_user
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("""
-        SELECT e.last_name, e.first_name
-        FROM employees e
-        JOIN online_status o ON e.id = o.employee_id
-        WHERE o.is_online=TRUE
-          AND e.department_id = (SELECT department_id FROM employees WHERE telegram_id=%s)
-          AND e.division_id   = (SELECT division_id   FROM employees WHERE telegram_id=%s);
-    """, (user.id, user.id))
-    rows = cur.fetchall()
-    release_conn(conn)
-    if not rows:
-        text = "Сейчас никто из ваших коллег не в сети."
-    else:
-        text = "Коллеги в сети:\n" + "\n".join(f"{ln} {fn}" for ln, fn in rows)
-    await update.message.reply_text(text)
+    emp = context.employee
+    if not emp:
+        await update.message.reply_text("Сейчас никто из ваших коллег не в сети.")
+        return
+    text, kb = _colleagues_page(emp, 0)
+    await update.message.reply_text(text, reply_markup=kb)
+
+
+async def colleagues_page_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    emp = context.employee
+    if not emp:
+        return
+    text, kb = _colleagues_page(emp, int(query.data.rsplit("_", 1)[1]))
+    await query.edit_message_text(text, reply_markup=kb)
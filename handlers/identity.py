@@ -0,0 +1,19 @@
+from telegram import Update
+from telegram.ext import ContextTypes, TypeHandler
+from database import run_db
+from models import employee_cache, get_employee_by_telegram
+
+
+async def resolve_employee(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # runs in group -1, before every other handler; the resolved Employee
+    # (or None for unregistered users) is available as context.employee
+    user = update.effective_user
+    emp = None
+    if user:
+        emp = employee_cache.get(user.id)
+        if emp is None:
+            emp = await run_db(get_employee_by_telegram, user.id)
+    context.employee = emp
+
+def identity_handler() -> TypeHandler:
+    return TypeHandler(Update, resolve_employee)
@@ -1,9 +1,9 @@
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import ContextTypes, ConversationHandler, CommandHandler, MessageHandler, filters
-from database import get_conn, release_conn
-from models import INSERT_EMPLOYEE, SELECT_EMPLOYEE_BY_TG
+from config import PERSISTENCE_ENABLED
+from database import run_db
 from handlers.work import work_keyboard
-from models import get_employee_by_telegram
+from models import get_employee_by_telegram, create_employee, get_directory
 
 (
     ASK_LAST_NAME,
@@ -14,32 +14,30 @@ from models import get_employee_by_telegram
 ) = range(5)
 
 def load_departments():
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT id, name FROM departments;")
-    deps = cur.fetchall()
+    deps, divs = get_directory()
     dep_map = {name: idx for idx, name in deps}
-    cur.execute("SELECT dv.department_id, dv.id, dv.name FROM divisions dv JOIN departments d ON dv.department_id = d.id;")
     div_map = {}
-    for dep_id, div_id, div_name in cur.fetchall():
+    for dep_id, div_id, div_name in divs:
         div_map.setdefault(dep_id, {})[div_name] = div_id
-    release_conn(conn)
     return dep_map, div_map
 
-DEPS, DIVS = load_departments()
+# filled in place by reload_directory() so modules that imported them see updates
+DEPS, DIVS = {}, {}
+
+def reload_directory():
+    # updated without clearing first, so handlers never see an empty directory
+    dep_map, div_map = load_departments()
+    for current, fresh in ((DEPS, dep_map), (DIVS, div_map)):
+        current.update(fresh)
+        for key in set(current) - set(fresh):
+            del current[key]
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    tg_id = update.effective_user.id
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute(SELECT_EMPLOYEE_BY_TG, (tg_id,))
-    if cur.fetchone():
-        emp = get_employee_by_telegram(tg_id)
-        is_admin = (emp and emp[1] == 'admin')
+    emp = context.employee
+    if emp:
+        is_admin = emp.role == 'admin'
         await update.message.reply_text("Вы уже зарегистрированы. Выберите действие:", reply_markup = work_keyboard(is_admin))
-
-        release_conn(conn)
         return ConversationHandler.END
-    release_conn(conn)
     await update.message.reply_text("Добро пожаловать! Пожалуйста, введите Вашу фамилию:")
     return ASK_LAST_NAME
 
@@ -73,24 +71,17 @@ async def division(update: Update, context: ContextTypes.DEFAULT_TYPE):
     dep_id = context.user_data['department_id']
     div_id = DIVS[dep_id][div_name]
     data = context.user_data
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute(
-        INSERT_EMPLOYEE,
-        (
-            update.effective_user.id,
-            data['last_name'],
-            data['first_name'],
-            data['patronymic'],
-            dep_id,
-            div_id
-        )
+    await run_db(
+        create_employee,
+        update.effective_user.id,
+        data['last_name'],
+        data['first_name'],
+        data['patronymic'],
+        dep_id,
+        div_id
     )
-    conn.commit()
-    cur.execute("INSERT INTO online_status (employee_id, is_online) VALUES ((SELECT id FROM employees WHERE telegram_id=%s), FALSE) ON CONFLICT (employee_id) DO NOTHING;", (update.effective_user.id,))
-    conn.commit()
-    release_conn(conn)
-    emp = get_employee_by_telegram(update.effective_user.id)
-    is_admin = (emp and emp[1] == 'admin')
+    emp = await run_db(get_employee_by_telegram, update.effective_user.id)
+    is_admin = (emp and emp.role == 'admin')
     await update.message.reply_text("Регистрация завершена! Выберите действие:", reply_markup = work_keyboard(is_admin))
     return ConversationHandler.END
 
@@ -109,4 +100,6 @@ def registration_handler():
             ASK_DIVISION: [MessageHandler(filters.TEXT & ~filters.COMMAND, division)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="registration",
+        persistent=PERSISTENCE_ENABLED,
     )
@@ -15,7 +15,13 @@ from telegram.ext import (
     filters,
 )
 import datetime
-from models import create_reminder, get_reminders, delete_reminder, get_employee_by_telegram
+from config import PERSISTENCE_ENABLED
+from database import run_db
+from models import create_reminder, get_reminders, delete_reminder
+from reminder_scheduler import schedule
+from reminder_rules import (
+    RULE_DAILY, RULE_WEEKDAYS, describe_rule, first_fire, parse_weekdays, session_minutes, session_rule, weekly_rule,
+)
 
 
 (
@@ -23,26 +29,34 @@ from models import create_reminder, get_reminders, delete_reminder, get_employee
     ASK_REMINDER_TEXT,
     ASK_REMINDER_DATETIME,
     CONFIRM_DELETE,
-) = range(4)
+    ASK_REPEAT,
+    ASK_WEEKDAYS,
+    ASK_INTERVAL,
+) = range(7)
 
 REMINDER_STATES = {
     "LISTING": LISTING,
     "ASK_TEXT": ASK_REMINDER_TEXT,
     "ASK_DATETIME": ASK_REMINDER_DATETIME,
     "CONFIRM_DELETE": CONFIRM_DELETE,
+    "ASK_REPEAT": ASK_REPEAT,
+    "ASK_WEEKDAYS": ASK_WEEKDAYS,
+    "ASK_INTERVAL": ASK_INTERVAL,
 }
 
-temp_data = {}
+DATETIME_PROMPT = (
+    "Введите дату и время напоминания в формате YYYY-MM-DD HH:MM (24-часовой формат),\n"
+    "например: 2025-06-05 14:30"
+)
 
 async def reminders_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.message.from_user
-    emp = get_employee_by_telegram(user.id)
+    emp = context.employee
     if not emp:
         await update.message.reply_text("Сначала зарегистрируйтесь через /start.")
         return ConversationHandler.END
-    employee_id = emp[0]
+    employee_id = emp.id
 
-    rows = get_reminders(employee_id)
+    rows = await run_db(get_reminders, employee_id)
     if not rows:
         text = "У вас пока нет сохранённых напоминаний."
         keyboard = [
@@ -52,9 +66,14 @@ async def reminders_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     else:
         lines = []
         buttons = []
-        for rid, remind_at, msg in rows:
+        for rid, remind_at, msg, rule in rows:
             dt_str = remind_at.strftime("%Y-%m-%d %H:%M")
-            lines.append(f"{rid}. [{dt_str}] {msg}")
+            if session_minutes(rule):
+                lines.append(f"{rid}. [{describe_rule(rule)}] {msg}")
+            elif rule:
+                lines.append(f"{rid}. [{dt_str}, {describe_rule(rule)}] {msg}")
+            else:
+                lines.append(f"{rid}. [{dt_str}] {msg}")
             buttons.append([InlineKeyboardButton(f"Удалить {rid}", callback_data=f"del_{rid}")])
         text = "Ваши напоминания:\n" + "\n".join(lines)
         keyboard = [
@@ -81,7 +100,7 @@ async def handle_list_choice(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     if data.startswith("del_"):
         rid = int(data.split("_", 1)[1])
-        temp_data["del_id"] = rid
+        context.user_data["reminder_del_id"] = rid
         await query.edit_message_text(f"Вы уверены, что хотите удалить напоминание #{rid}?",
                                        reply_markup=InlineKeyboardMarkup([
                                            [InlineKeyboardButton("Да, удалить", callback_data="confirm_delete")],
@@ -96,16 +115,65 @@ async def handle_list_choice(update: Update, context: ContextTypes.DEFAULT_TYPE)
     return ConversationHandler.END
 
 async def ask_reminder_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    temp_data["message"] = update.message.text
-    await update.message.reply_text(
-        "Введите дату и время напоминания в формате YYYY-MM-DD HH:MM (24-часовой формат),\n"
-        "например: 2025-06-05 14:30"
-    )
+    context.user_data["reminder_message"] = update.message.text
+    context.user_data["reminder_rule"] = None
+    await update.message.reply_text("Как часто напоминать?", reply_markup=InlineKeyboardMarkup([
+        [InlineKeyboardButton("Один раз", callback_data="repeat_once")],
+        [InlineKeyboardButton("Каждый день", callback_data="repeat_daily"),
+         InlineKeyboardButton("По будням", callback_data="repeat_weekdays")],
+        [InlineKeyboardButton("По дням недели", callback_data="repeat_weekly")],
+        [InlineKeyboardButton("Каждые N минут на смене", callback_data="repeat_session")],
+    ]))
+    return ASK_REPEAT
+
+async def ask_repeat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    data = query.data
+
+    if data == "repeat_weekly":
+        await query.edit_message_text("Введите дни недели через пробел, например: пн ср пт")
+        return ASK_WEEKDAYS
+    if data == "repeat_session":
+        await query.edit_message_text("Раз в сколько минут напоминать во время смены? Например: 60")
+        return ASK_INTERVAL
+
+    context.user_data["reminder_rule"] = {"repeat_daily": RULE_DAILY, "repeat_weekdays": RULE_WEEKDAYS}.get(data)
+    await query.edit_message_text(DATETIME_PROMPT)
+    return ASK_REMINDER_DATETIME
+
+async def ask_weekdays(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    days = parse_weekdays(update.message.text)
+    if not days:
+        await update.message.reply_text("Не понял дни недели. Используйте пн, вт, ср, чт, пт, сб, вс.")
+        return ASK_WEEKDAYS
+    context.user_data["reminder_rule"] = weekly_rule(days)
+    await update.message.reply_text(DATETIME_PROMPT)
     return ASK_REMINDER_DATETIME
 
+async def ask_interval(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    emp = context.employee
+    if not emp:
+        await update.message.reply_text("Сначала зарегистрируйтесь через /start.")
+        return ConversationHandler.END
+
+    text = update.message.text.strip()
+    if not text.isdigit() or not 1 <= int(text) <= 24 * 60:
+        await update.message.reply_text("Введите число минут от 1 до 1440.")
+        return ASK_INTERVAL
+
+    minutes = int(text)
+    rule = session_rule(minutes)
+    remind_at = datetime.datetime.now() + datetime.timedelta(minutes=minutes)
+    rid, saved_dt, saved_msg = await run_db(create_reminder, emp.id, remind_at, context.user_data.get("reminder_message"), rule)
+    schedule(rid, saved_dt)
+
+    await update.message.reply_text(f"Напоминание сохранено: {describe_rule(rule)}.")
+
+    return await reminders_callback(update, context)
+
 async def ask_reminder_datetime(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.message.from_user
-    emp = get_employee_by_telegram(user.id)
+    emp = context.employee
     if not emp:
         await update.message.reply_text("Сначала зарегистрируйтесь через /start.")
         return ConversationHandler.END
@@ -124,52 +192,42 @@ async def ask_reminder_datetime(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("Вы указали прошлую дату. Введите дату/время, которое ещё не наступило.")
         return ASK_REMINDER_DATETIME
 
-    message = temp_data.get("message")
-    employee_id = emp[0]
-    new_row = create_reminder(employee_id, remind_at, message)
+    message = context.user_data.get("reminder_message")
+    rule = context.user_data.get("reminder_rule")
+    employee_id = emp.id
+    new_row = await run_db(create_reminder, employee_id, first_fire(rule, remind_at), message, rule)
     rid, saved_dt, saved_msg = new_row
+    schedule(rid, saved_dt)
 
-    context.application.job_queue.run_once(
-        callback=send_reminder_job,
-        when=(saved_dt - now),
-        data={
-            "chat_id": update.effective_chat.id,
-            "message": saved_msg,
-            "reminder_id": rid,
-        },
-        name=f"reminder_{rid}_{employee_id}",
-    )
-
-    await update.message.reply_text(f"Напоминание сохранено на {saved_dt.strftime('%Y-%m-%d %H:%M')}.")
+    text = f"Напоминание сохранено на {saved_dt.strftime('%Y-%m-%d %H:%M')}"
+    if rule:
+        text += f", {describe_rule(rule)}"
+    await update.message.reply_text(text + ".")
 
     return await reminders_callback(update, context)
 
 async def confirm_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    rid = temp_data.get("del_id")
+    rid = context.user_data.get("reminder_del_id")
     if rid:
-        delete_reminder(rid)
-        for job in context.application.job_queue.get_jobs_by_name(f"reminder_{rid}_{query.from_user.id}"):
-            job.schedule_removal()
+        # an already queued copy is skipped when its row turns out to be gone
+        await run_db(delete_reminder, rid)
         await query.edit_message_text(f"Напоминание #{rid} удалено.")
     else:
         await query.edit_message_text("Что-то пошло не так. Напоминание не найдено.")
 
     return await reminders_callback(update, context)
 
-async def send_reminder_job(context: ContextTypes.DEFAULT_TYPE):
-    job_data = context.job.data
-    chat_id = job_data["chat_id"]
-    message = job_data["message"]
-    await context.bot.send_message(chat_id=chat_id, text=f"Напоминание: {message}")
-
 def reminders_handler() -> ConversationHandler:
     return ConversationHandler(
         entry_points=[CallbackQueryHandler(handle_list_choice, pattern="^(add_reminder|del_\\d+|cancel_reminders)$")],
         states={
             LISTING: [CallbackQueryHandler(handle_list_choice, pattern="^(add_reminder|del_\\d+|cancel_reminders)$")],
             ASK_REMINDER_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_reminder_text)],
+            ASK_REPEAT: [CallbackQueryHandler(ask_repeat, pattern="^repeat_(once|daily|weekdays|weekly|session)$")],
+            ASK_WEEKDAYS: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_weekdays)],
+            ASK_INTERVAL: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_interval)],
             ASK_REMINDER_DATETIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_reminder_datetime)],
             CONFIRM_DELETE: [CallbackQueryHandler(confirm_delete, pattern="^(confirm_delete|cancel_reminders)$")],
         },
@@ -177,4 +235,6 @@ def reminders_handler() -> ConversationHandler:
         map_to_parent={
             ConversationHandler.END: ConversationHandler.END,
         },
+        name="reminders",
+        persistent=PERSISTENCE_ENABLED,
     )
\ No newline at end of file
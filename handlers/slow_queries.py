@@ -0,0 +1,42 @@
+from telegram import Update
+from telegram.ext import ContextTypes
+from config import QUERY_PROFILE_LOG
+import query_profile
+
+ORDERS = {"total": "по общему времени", "max": "по худшему времени", "calls": "по числу вызовов", "slow": "по числу медленных"}
+MESSAGE_LIMIT = 4000
+
+
+async def slow_queries_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /slow_queries [N] [total|max|calls|slow]
+    emp = context.employee
+    if not emp or emp.role != "admin":
+        await update.message.reply_text("У вас нет прав администратора.")
+        return
+    if not query_profile.enabled():
+        await update.message.reply_text("Профилирование запросов выключено, включите QUERY_PROFILE=1.")
+        return
+
+    n, by = 10, "total"
+    for arg in context.args or ():
+        if arg.isdigit():
+            n = max(1, min(int(arg), 50))
+        elif arg in ORDERS:
+            by = arg
+    rows = query_profile.top(n, by)
+    if not rows:
+        await update.message.reply_text("Запросов пока не было.")
+        return
+
+    lines = [f"Топ-{len(rows)} запросов {ORDERS[by]}:"]
+    for i, (key, label, _text, calls, total, worst, slow) in enumerate(rows, 1):
+        lines.append(
+            f"{i}. {label}\n"
+            f"   {calls} раз, всего {total:.3f} с, ср. {total / calls * 1000:.1f} мс, "
+            f"макс. {worst * 1000:.0f} мс, медленных {slow} [{key}]"
+        )
+    lines.append(f"Планы медленных запросов: {QUERY_PROFILE_LOG}")
+    text = "\n".join(lines)
+    if len(text) > MESSAGE_LIMIT:
+        text = text[:MESSAGE_LIMIT] + "…"
+    await update.message.reply_text(text)
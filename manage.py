@@ -0,0 +1,78 @@
+import argparse
+import datetime
+from migrations import migrate
+from models import rebuild_daily_totals, recompute_overtime, set_calendar_day, set_work_norm
+
+
+def cmd_migrate(args):
+    applied = migrate()
+    if not applied:
+        print("Схема актуальна, новых миграций нет.")
+    for version, name in applied:
+        print(f"Применена миграция {version}: {name}")
+
+
+def cmd_rebuild_totals(args):
+    count = rebuild_daily_totals(args.start, args.end)
+    print(f"Пересчитано строк daily_work_totals: {count}")
+
+
+def cmd_recompute_overtime(args):
+    if (args.department is None) != (args.division is None):
+        raise SystemExit("--department и --division указываются вместе")
+    days, employees = recompute_overtime(args.start, args.end, args.department, args.division)
+    print(f"Переработка пересчитана: дней изменено {days}, сотрудников {employees}")
+
+
+def cmd_set_norm(args):
+    set_work_norm(args.division, args.hours * 3600, args.weekend)
+    print("Норма сохранена. Прошедшие дни пересчитает recompute-overtime.")
+
+
+def cmd_calendar(args):
+    is_working = {"holiday": False, "working": True, "reset": None}[args.kind]
+    set_calendar_day(args.day, is_working, args.note)
+    print("Календарь обновлён. Прошедшие дни пересчитает recompute-overtime.")
+
+
+def _date(text):
+    return datetime.datetime.strptime(text, "%Y-%m-%d").date()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Обслуживание базы данных бота.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("migrate", help="применить миграции схемы")
+    p.set_defaults(func=cmd_migrate)
+
+    p = sub.add_parser("rebuild-totals", help="пересчитать daily_work_totals по сырым сессиям")
+    p.add_argument("--from", dest="start", type=_date, help="первый день (YYYY-MM-DD), по умолчанию вся история")
+    p.add_argument("--to", dest="end", type=_date, help="последний день (YYYY-MM-DD), по умолчанию вся история")
+    p.set_defaults(func=cmd_rebuild_totals)
+
+    p = sub.add_parser("recompute-overtime", help="пересчитать переработку по норме и календарю")
+    p.add_argument("--from", dest="start", type=_date, help="первый день (YYYY-MM-DD), по умолчанию вся история")
+    p.add_argument("--to", dest="end", type=_date, help="последний день (YYYY-MM-DD), по умолчанию вся история")
+    p.add_argument("--department", type=int, help="id департамента, по умолчанию все")
+    p.add_argument("--division", type=int, help="id отдела, по умолчанию все")
+    p.set_defaults(func=cmd_recompute_overtime)
+
+    p = sub.add_parser("set-norm", help="задать дневную норму отдела или норму по умолчанию")
+    p.add_argument("--division", type=int, help="id отдела, без него — норма по умолчанию")
+    p.add_argument("--hours", type=float, required=True, help="часов в рабочий день")
+    p.add_argument("--weekend", type=lambda text: [int(d) for d in text.split(",") if d], default=[6, 7],
+                   help="выходные дни недели через запятую, 1 — понедельник (по умолчанию 6,7)")
+    p.set_defaults(func=cmd_set_norm)
+
+    p = sub.add_parser("calendar", help="отметить праздник или рабочий выходной")
+    p.add_argument("kind", choices=["holiday", "working", "reset"])
+    p.add_argument("day", type=_date, help="день (YYYY-MM-DD)")
+    p.add_argument("--note", help="например, название праздника")
+    p.set_defaults(func=cmd_calendar)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
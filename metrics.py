@@ -0,0 +1,213 @@
+import bisect
+import logging
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Latency histograms kept in process and served in the Prometheus text format.
+# Recording one value is a bisect and a few additions under a lock, so they
+# stay on in production; everything else happens when the endpoint is read
+# or the summary is logged.
+
+# bucket upper bounds in seconds; anything slower lands in +Inf
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# a series is [count per bucket..., count over the last bound, sum, errors]
+_SUM = -2
+_ERRORS = -1
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, label: str = None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._series = {}  # label value (None without a label) -> series
+        self._lock = threading.Lock()
+
+    def observe(self, key, seconds: float, error: bool = False):
+        i = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(BUCKETS) + 3)
+            series[i] += 1
+            series[_SUM] += seconds
+            if error:
+                series[_ERRORS] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {key: list(series) for key, series in self._series.items()}
+
+
+def count(series: list) -> int:
+    return sum(series[:_SUM])
+
+
+def quantile(series: list, q: float) -> float:
+    # the upper bound of the bucket holding the q-th value
+    target = q * count(series)
+    running = 0
+    for bound, n in zip(BUCKETS + (math.inf,), series):
+        running += n
+        if running and running >= target:
+            return bound
+    return 0.0
+
+
+HANDLERS = Histogram("bot_handler_seconds", "Time spent in a handler callback", "handler")
+QUERIES = Histogram("bot_db_query_seconds", "Time to execute a statement and fetch its rows", "statement")
+POOL_WAIT = Histogram("bot_db_pool_wait_seconds", "Time to check a connection out of the pool")
+EXECUTOR_WAIT = Histogram("bot_db_executor_wait_seconds", "Time a database call queues for an executor thread")
+BOT_API = Histogram("bot_api_seconds", "Bot API request time, rate limiter waits excluded", "endpoint")
+
+HISTOGRAMS = [HANDLERS, QUERIES, POOL_WAIT, EXECUTOR_WAIT, BOT_API]
+
+# callables returning (name, type, help, [(labels dict, value), ...]) tuples,
+# read on every scrape for gauges and counters kept elsewhere
+_collectors = []
+
+
+def add_collector(collect):
+    _collectors.append(collect)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(pairs) -> str:
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _render_histogram(histogram: Histogram, lines: list):
+    snapshot = sorted(histogram.snapshot().items(), key=lambda item: str(item[0]))
+    lines.append(f"# HELP {histogram.name} {histogram.help}")
+    lines.append(f"# TYPE {histogram.name} histogram")
+    for key, series in snapshot:
+        base = [(histogram.label, key)] if histogram.label else []
+        running = 0
+        for bound, n in zip(BUCKETS + (math.inf,), series):
+            running += n
+            le = "+Inf" if bound == math.inf else repr(bound)
+            lines.append(f"{histogram.name}_bucket{_labels(base + [('le', le)])} {running}")
+        lines.append(f"{histogram.name}_sum{_labels(base)} {series[_SUM]!r}")
+        lines.append(f"{histogram.name}_count{_labels(base)} {running}")
+    errors = histogram.name.replace("_seconds", "_errors_total")
+    lines.append(f"# HELP {errors} Calls that raised, counted in {histogram.name} too")
+    lines.append(f"# TYPE {errors} counter")
+    for key, series in snapshot:
+        base = [(histogram.label, key)] if histogram.label else []
+        lines.append(f"{errors}{_labels(base)} {series[_ERRORS]}")
+
+
+def render() -> str:
+    lines = []
+    for histogram in HISTOGRAMS:
+        _render_histogram(histogram, lines)
+    for collect in _collectors:
+        try:
+            families = list(collect())
+        except Exception:
+            logger.exception("metrics collector %r failed", collect)
+            continue
+        for name, kind, help, samples in families:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{_labels(sorted(labels.items()))} {value!r}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+
+
+def start_server(host: str, port: int):
+    # GET /metrics on a thread of its own, so a scrape never waits for the bot
+    global _server
+    if _server is None:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        _server = server
+        logger.info("metrics on http://%s:%d/metrics", host, server.server_address[1])
+
+
+def stop_server():
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
+
+
+_last_logged = {}  # histogram name -> snapshot at the previous summary
+
+
+def log_summary(top: int = 10):
+    # what happened since the previous summary: the series with the most
+    # total time first, with bucket-resolution p50 and p95
+    for histogram in HISTOGRAMS:
+        current = histogram.snapshot()
+        previous = _last_logged.get(histogram.name, {})
+        _last_logged[histogram.name] = current
+        delta = {}
+        for key, series in current.items():
+            before = previous.get(key)
+            series = [a - b for a, b in zip(series, before)] if before else series
+            if count(series):
+                delta[key] = series
+        if not delta:
+            continue
+        parts = []
+        for key, series in sorted(delta.items(), key=lambda item: -item[1][_SUM])[:top]:
+            n = count(series)
+            part = (f"{key or 'all'} n={n} avg={series[_SUM] / n * 1000:.1f}ms "
+                    f"p50<={quantile(series, 0.5) * 1000:g}ms p95<={quantile(series, 0.95) * 1000:g}ms")
+            if series[_ERRORS]:
+                part += f" errors={series[_ERRORS]}"
+            parts.append(part)
+        logger.info("%s: %s", histogram.name, "; ".join(parts))
+
+
+async def log_job(context):
+    log_summary()
+
+
+class timer:
+    # with timer(HISTOGRAM, key): ...  counts an exception as an error
+    __slots__ = ("histogram", "key", "started")
+
+    def __init__(self, histogram: Histogram, key=None):
+        self.histogram = histogram
+        self.key = key
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(self.key, time.perf_counter() - self.started, exc_type is not None)
+        return False
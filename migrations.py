@@ -0,0 +1,301 @@
+from database import connection
+
+# Each migration runs once, in its own transaction, in version order. Tables
+# created by hand before the runner existed are picked up by IF NOT EXISTS.
+MIGRATIONS = [
+    (1, "baseline", """
+CREATE TABLE IF NOT EXISTS departments (
+    id SERIAL PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS divisions (
+    id SERIAL PRIMARY KEY,
+    department_id INTEGER NOT NULL REFERENCES departments (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    UNIQUE (department_id, name)
+);
+CREATE TABLE IF NOT EXISTS employees (
+    id SERIAL PRIMARY KEY,
+    telegram_id BIGINT NOT NULL UNIQUE,
+    last_name TEXT NOT NULL,
+    first_name TEXT NOT NULL,
+    patronymic TEXT,
+    department_id INTEGER REFERENCES departments (id),
+    division_id INTEGER REFERENCES divisions (id),
+    role TEXT NOT NULL DEFAULT 'worker',
+    overtime INTERVAL NOT NULL DEFAULT INTERVAL '0',
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+CREATE TABLE IF NOT EXISTS online_status (
+    employee_id INTEGER PRIMARY KEY REFERENCES employees (id) ON DELETE CASCADE,
+    is_online BOOLEAN NOT NULL DEFAULT FALSE,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+CREATE TABLE IF NOT EXISTS work_sessions (
+    id SERIAL PRIMARY KEY,
+    employee_id INTEGER NOT NULL REFERENCES employees (id) ON DELETE CASCADE,
+    started_at TIMESTAMP NOT NULL,
+    ended_at TIMESTAMP,
+    duration INTERVAL
+);
+CREATE TABLE IF NOT EXISTS breaks (
+    id SERIAL PRIMARY KEY,
+    session_id INTEGER NOT NULL REFERENCES work_sessions (id) ON DELETE CASCADE,
+    started_at TIMESTAMP NOT NULL,
+    ended_at TIMESTAMP,
+    duration INTERVAL
+);
+CREATE TABLE IF NOT EXISTS reminders (
+    id SERIAL PRIMARY KEY,
+    employee_id INTEGER NOT NULL REFERENCES employees (id) ON DELETE CASCADE,
+    remind_at TIMESTAMP NOT NULL,
+    message TEXT NOT NULL
+);
+"""),
+    (2, "online_status current state", """
+ALTER TABLE online_status
+    ADD COLUMN IF NOT EXISTS session_id INTEGER REFERENCES work_sessions (id) ON DELETE SET NULL,
+    ADD COLUMN IF NOT EXISTS break_id INTEGER REFERENCES breaks (id) ON DELETE SET NULL;
+
+UPDATE online_status o
+SET session_id = (
+        SELECT w.id FROM work_sessions w
+        WHERE w.employee_id = o.employee_id AND w.ended_at IS NULL
+        ORDER BY w.started_at DESC LIMIT 1
+    ),
+    break_id = (
+        SELECT b.id FROM breaks b JOIN work_sessions w ON b.session_id = w.id
+        WHERE w.employee_id = o.employee_id AND w.ended_at IS NULL AND b.ended_at IS NULL
+        ORDER BY b.started_at DESC LIMIT 1
+    );
+"""),
+    (3, "hot query indexes", """
+CREATE UNIQUE INDEX IF NOT EXISTS employees_telegram_id_key ON employees (telegram_id);
+CREATE INDEX IF NOT EXISTS employees_department_division_idx ON employees (department_id, division_id);
+CREATE INDEX IF NOT EXISTS work_sessions_employee_started_idx ON work_sessions (employee_id, started_at);
+CREATE INDEX IF NOT EXISTS work_sessions_open_idx ON work_sessions (employee_id) WHERE ended_at IS NULL;
+CREATE INDEX IF NOT EXISTS breaks_open_idx ON breaks (session_id) WHERE ended_at IS NULL;
+"""),
+    (4, "daily work rollup", """
+CREATE TABLE IF NOT EXISTS daily_work_totals (
+    employee_id INTEGER NOT NULL REFERENCES employees (id) ON DELETE CASCADE,
+    day DATE NOT NULL,
+    worked_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+    break_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+    session_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (employee_id, day)
+);
+CREATE INDEX IF NOT EXISTS breaks_session_idx ON breaks (session_id);
+
+INSERT INTO daily_work_totals (employee_id, day, worked_seconds, break_seconds, session_count)
+SELECT
+    w.employee_id,
+    w.started_at::date,
+    COALESCE(SUM(EXTRACT(EPOCH FROM w.duration)), 0),
+    COALESCE(SUM(b.secs), 0),
+    COUNT(w.duration)
+FROM work_sessions w
+LEFT JOIN LATERAL (
+    SELECT SUM(EXTRACT(EPOCH FROM duration)) AS secs
+    FROM breaks WHERE session_id = w.id AND duration IS NOT NULL
+) b ON TRUE
+GROUP BY w.employee_id, w.started_at::date
+HAVING COUNT(w.duration) > 0 OR SUM(b.secs) > 0
+ON CONFLICT (employee_id, day) DO NOTHING;
+"""),
+    (5, "reminder delivery", """
+ALTER TABLE reminders ADD COLUMN IF NOT EXISTS delivered_at TIMESTAMP;
+CREATE INDEX IF NOT EXISTS reminders_pending_idx ON reminders (remind_at, id) WHERE delivered_at IS NULL;
+"""),
+    (6, "recurring reminders", """
+ALTER TABLE reminders ADD COLUMN IF NOT EXISTS rule TEXT;
+"""),
+    (7, "change notifications", """
+CREATE OR REPLACE FUNCTION notify_employee_change() RETURNS trigger AS $$
+DECLARE
+    changed employees;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        changed := OLD;
+    ELSE
+        changed := NEW;
+    END IF;
+    PERFORM pg_notify('bot_events', json_build_object(
+        'kind', 'employee', 'id', changed.id, 'telegram_id', changed.telegram_id)::text);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION notify_presence_change() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('bot_events', json_build_object(
+        'kind', 'presence', 'employee_id', NEW.employee_id, 'online', NEW.is_online)::text);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION notify_directory_change() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('bot_events', json_build_object('kind', 'directory')::text);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS employees_notify ON employees;
+CREATE TRIGGER employees_notify
+AFTER INSERT OR DELETE OR UPDATE OF telegram_id, last_name, first_name, department_id, division_id, role ON employees
+FOR EACH ROW EXECUTE FUNCTION notify_employee_change();
+
+DROP TRIGGER IF EXISTS online_status_notify ON online_status;
+CREATE TRIGGER online_status_notify
+AFTER UPDATE OF is_online ON online_status
+FOR EACH ROW WHEN (OLD.is_online IS DISTINCT FROM NEW.is_online)
+EXECUTE FUNCTION notify_presence_change();
+
+DROP TRIGGER IF EXISTS departments_notify ON departments;
+CREATE TRIGGER departments_notify
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON departments
+FOR EACH STATEMENT EXECUTE FUNCTION notify_directory_change();
+
+DROP TRIGGER IF EXISTS divisions_notify ON divisions;
+CREATE TRIGGER divisions_notify
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON divisions
+FOR EACH STATEMENT EXECUTE FUNCTION notify_directory_change();
+"""),
+    (8, "bot state", """
+CREATE TABLE IF NOT EXISTS bot_state (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BYTEA NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (namespace, key)
+);
+"""),
+    (9, "overtime", """
+-- the daily norm of a division; the row without a division applies to
+-- every division that has none of its own
+CREATE TABLE IF NOT EXISTS work_norms (
+    division_id INTEGER REFERENCES divisions (id) ON DELETE CASCADE,
+    daily_seconds DOUBLE PRECISION NOT NULL,
+    weekend_days INTEGER[] NOT NULL DEFAULT '{6,7}'  -- ISO days of the week, Monday is 1
+);
+CREATE UNIQUE INDEX IF NOT EXISTS work_norms_division_key ON work_norms (COALESCE(division_id, 0));
+INSERT INTO work_norms (division_id, daily_seconds)
+SELECT NULL, 8 * 3600 WHERE NOT EXISTS (SELECT 1 FROM work_norms WHERE division_id IS NULL);
+
+-- holidays (is_working false) and working weekends (true) for everyone
+CREATE TABLE IF NOT EXISTS work_calendar (
+    day DATE PRIMARY KEY,
+    is_working BOOLEAN NOT NULL,
+    note TEXT
+);
+
+ALTER TABLE daily_work_totals
+    ADD COLUMN IF NOT EXISTS norm_seconds DOUBLE PRECISION,
+    ADD COLUMN IF NOT EXISTS overtime_seconds DOUBLE PRECISION NOT NULL DEFAULT 0;
+
+-- the norm of a day: nothing on weekends and holidays, NULL without any norm
+CREATE OR REPLACE FUNCTION work_norm_seconds(DATE, BOOLEAN, DOUBLE PRECISION, INTEGER[])
+RETURNS DOUBLE PRECISION AS $$
+    SELECT CASE
+        WHEN $3 IS NULL THEN NULL
+        WHEN COALESCE($2, NOT EXTRACT(ISODOW FROM $1)::int = ANY ($4)) THEN $3
+        ELSE 0
+    END
+$$ LANGUAGE sql IMMUTABLE;
+"""),
+    (10, "auto close", """
+-- sessions and breaks nobody closed, ended by auto_close.py
+ALTER TABLE work_sessions ADD COLUMN IF NOT EXISTS auto_closed BOOLEAN NOT NULL DEFAULT FALSE;
+ALTER TABLE breaks ADD COLUMN IF NOT EXISTS auto_closed BOOLEAN NOT NULL DEFAULT FALSE;
+"""),
+    (11, "overtime backfill", """
+-- migration 9 only counted overtime from then on; the days before it get their
+-- norm and overtime here, as models.RECOMPUTE_DAILY_OVERTIME would set them
+UPDATE daily_work_totals t
+SET norm_seconds = x.norm,
+    overtime_seconds = GREATEST(0, t.worked_seconds - t.break_seconds - x.norm)
+FROM (
+    SELECT t.employee_id, t.day,
+           work_norm_seconds(t.day, (SELECT is_working FROM work_calendar WHERE day = t.day),
+                             COALESCE(n.daily_seconds, dn.daily_seconds),
+                             COALESCE(n.weekend_days, dn.weekend_days)) AS norm
+    FROM daily_work_totals t
+    JOIN employees e ON e.id = t.employee_id
+    LEFT JOIN work_norms n ON n.division_id = e.division_id
+    LEFT JOIN work_norms dn ON dn.division_id IS NULL
+) x
+WHERE t.employee_id = x.employee_id AND t.day = x.day
+  AND (t.norm_seconds IS DISTINCT FROM x.norm
+       OR t.overtime_seconds <> GREATEST(0, t.worked_seconds - t.break_seconds - x.norm));
+
+-- and employees.overtime becomes their sum, as models.SYNC_EMPLOYEE_OVERTIME
+UPDATE employees e
+SET overtime = make_interval(secs => s.seconds)
+FROM (
+    SELECT e.id, COALESCE(SUM(t.overtime_seconds), 0) AS seconds
+    FROM employees e
+    LEFT JOIN daily_work_totals t ON t.employee_id = e.id
+    GROUP BY e.id
+) s
+WHERE e.id = s.id AND e.overtime <> make_interval(secs => s.seconds);
+"""),
+    (12, "session reminder index", """
+-- PUNCH_START_WORK re-arms the employee's "every N minutes at work" reminders
+CREATE INDEX IF NOT EXISTS reminders_session_idx ON reminders (employee_id) WHERE rule LIKE 'session:%';
+"""),
+    (13, "session close notifications", """
+-- presence events say whether a session was closed, the only change that
+-- invalidates personal stats; a session auto-closed on a break changes no
+-- is_online but is announced as well
+CREATE OR REPLACE FUNCTION notify_presence_change() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('bot_events', json_build_object(
+        'kind', 'presence', 'employee_id', NEW.employee_id, 'online', NEW.is_online,
+        'session_closed', OLD.session_id IS NOT NULL AND NEW.session_id IS NULL)::text);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS online_status_notify ON online_status;
+CREATE TRIGGER online_status_notify
+AFTER UPDATE OF is_online, session_id ON online_status
+FOR EACH ROW WHEN (OLD.is_online IS DISTINCT FROM NEW.is_online
+                   OR (OLD.session_id IS NOT NULL AND NEW.session_id IS NULL))
+EXECUTE FUNCTION notify_presence_change();
+"""),
+]
+
+CREATE_SCHEMA_MIGRATIONS = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+"""
+
+# serializes runners started by several bot processes at once
+MIGRATION_LOCK_ID = 7342001
+LOCK_MIGRATIONS = "SELECT pg_advisory_xact_lock(%s);"
+
+
+def migrate():
+    applied = []
+    with connection() as conn:
+        cur = conn.cursor()
+        # two runners creating the catalog at once would race on it
+        cur.execute(LOCK_MIGRATIONS, (MIGRATION_LOCK_ID,))
+        cur.execute(CREATE_SCHEMA_MIGRATIONS)
+        conn.commit()
+        for version, name, sql in MIGRATIONS:
+            cur.execute(LOCK_MIGRATIONS, (MIGRATION_LOCK_ID,))
+            cur.execute("SELECT 1 FROM schema_migrations WHERE version = %s;", (version,))
+            if cur.fetchone():
+                conn.commit()
+                continue
+            cur.execute(sql)
+            cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s);", (version, name))
+            conn.commit()
+            applied.append((version, name))
+    return applied
@@ -1,6 +1,53 @@
 import datetime
-from typing import List, Optional, Tuple
-from database import get_conn, release_conn
+import logging
+from typing import List, NamedTuple, Optional, Tuple
+import events
+import presence
+from cache import SizedCache, TTLCache
+from config import (
+    EMPLOYEE_CACHE_SIZE, EMPLOYEE_CACHE_TTL, STATS_CACHE_SIZE, STATS_CACHE_TTL,
+    REPORT_CACHE_MAX_BYTES, REPORT_CACHE_ITEM_MAX_BYTES, REPORT_CACHE_TTL,
+)
+from database import connection, name_statements, stream, timed_statement
+from reminder_rules import next_fire, session_minutes
+
+logger = logging.getLogger(__name__)
+
+
+class Employee(NamedTuple):
+    id: int
+    role: str
+    department_id: int
+    division_id: int
+
+
+PUNCH_OK = "ok"
+PUNCH_REJECTED = "rejected"
+
+# telegram_id -> Employee, shared by every handler of the process
+employee_cache = TTLCache(EMPLOYEE_CACHE_SIZE, EMPLOYEE_CACHE_TTL)
+# employee_id -> (day, personal stats); only a closed session changes them
+stats_cache = TTLCache(STATS_CACHE_SIZE, STATS_CACHE_TTL)
+
+# rough in-memory cost of one cached per-employee totals row
+REPORT_ROW_BYTES = 160
+
+
+def _report_size(value) -> int:
+    if isinstance(value, str):
+        return len(value.encode())
+    if isinstance(value, bytes):
+        return len(value)
+    return len(value) * REPORT_ROW_BYTES
+
+
+# (department_id, division_id, start, end, format) -> text report, the Telegram
+# file_id of an uploaded Excel report, or the per-employee totals of a period
+# when format is REPORT_TOTALS; closed periods only, and nothing over
+# REPORT_CACHE_ITEM_MAX_BYTES
+REPORT_TOTALS = "totals"
+report_cache = SizedCache(REPORT_CACHE_MAX_BYTES, REPORT_CACHE_TTL, sizeof=_report_size,
+                          maxitem=REPORT_CACHE_ITEM_MAX_BYTES)
 
 
 INSERT_EMPLOYEE = """
@@ -22,231 +69,834 @@ SET is_online = %s, updated_at = NOW()
 WHERE employee_id = %s;
 """
 
-INSERT_WORK_SESSION = """
-INSERT INTO work_sessions (employee_id, started_at)
-VALUES (%s, %s);
+# Punch statements: each takes parallel arrays of employee ids and punch times,
+# locks those employees' online_status rows (which also track the open session
+# and break, see migration 2) in id order, checks the state transition and
+# applies it. The ids that come back are the accepted punches. An employee may
+# appear at most once per statement. Closing a session also settles the day's
+# overtime against its norm (migration 9) and adds the change to
+# employees.overtime.
+PUNCH_START_WORK = """
+WITH state AS (
+    SELECT o.employee_id, p.at FROM online_status o
+    JOIN unnest(%s::int[], %s::timestamp[]) AS p(employee_id, at) ON p.employee_id = o.employee_id
+    WHERE o.session_id IS NULL AND NOT o.is_online
+    ORDER BY o.employee_id
+    FOR UPDATE OF o
+), session AS (
+    INSERT INTO work_sessions (employee_id, started_at)
+    SELECT employee_id, at FROM state
+    RETURNING id, employee_id, started_at
+), armed AS (
+    -- "every N minutes at work" reminders parked since the last shift
+    UPDATE reminders r
+    SET remind_at = s.started_at + split_part(r.rule, ':', 2)::int * INTERVAL '1 minute', delivered_at = NULL
+    FROM session s
+    WHERE r.employee_id = s.employee_id AND r.rule LIKE 'session:%'
+)
+UPDATE online_status o
+SET is_online = TRUE, session_id = s.id, break_id = NULL, updated_at = s.started_at
+FROM session s
+WHERE o.employee_id = s.employee_id
+RETURNING o.employee_id;
 """
-UPDATE_WORK_SESSION_END = """
-UPDATE work_sessions
-SET ended_at = %s, duration = %s - started_at
-WHERE employee_id = %s AND ended_at IS NULL;
+PUNCH_END_WORK = """
+WITH state AS (
+    SELECT o.employee_id, o.session_id, p.at FROM online_status o
+    JOIN unnest(%s::int[], %s::timestamp[]) AS p(employee_id, at) ON p.employee_id = o.employee_id
+    WHERE o.session_id IS NOT NULL AND o.break_id IS NULL AND o.is_online
+    ORDER BY o.employee_id
+    FOR UPDATE OF o
+), closed AS (
+    UPDATE work_sessions w
+    SET ended_at = s.at, duration = s.at - w.started_at
+    FROM state s
+    WHERE w.id = s.session_id
+    RETURNING w.employee_id, w.started_at, w.ended_at, w.duration
+), day_norm AS (
+    SELECT c.employee_id, c.started_at::date AS day, EXTRACT(EPOCH FROM c.duration) AS worked,
+           COALESCE(t.overtime_seconds, 0) AS overtime_before,
+           work_norm_seconds(c.started_at::date, cal.is_working, COALESCE(n.daily_seconds, dn.daily_seconds),
+                             COALESCE(n.weekend_days, dn.weekend_days)) AS norm
+    FROM closed c
+    JOIN employees e ON e.id = c.employee_id
+    LEFT JOIN work_norms n ON n.division_id = e.division_id
+    LEFT JOIN work_norms dn ON dn.division_id IS NULL
+    LEFT JOIN work_calendar cal ON cal.day = c.started_at::date
+    LEFT JOIN daily_work_totals t ON t.employee_id = c.employee_id AND t.day = c.started_at::date
+), rollup AS (
+    -- the day's breaks are all in by now: a session ends only off a break
+    INSERT INTO daily_work_totals AS t (employee_id, day, worked_seconds, session_count, norm_seconds, overtime_seconds)
+    SELECT employee_id, day, worked, 1, norm, GREATEST(0, worked - norm) FROM day_norm
+    ON CONFLICT (employee_id, day) DO UPDATE
+    SET worked_seconds = t.worked_seconds + EXCLUDED.worked_seconds,
+        session_count = t.session_count + 1,
+        norm_seconds = EXCLUDED.norm_seconds,
+        overtime_seconds = GREATEST(0, t.worked_seconds + EXCLUDED.worked_seconds - t.break_seconds - EXCLUDED.norm_seconds)
+    RETURNING t.employee_id, t.overtime_seconds
+), accrued AS (
+    UPDATE employees e
+    SET overtime = e.overtime + make_interval(secs => r.overtime_seconds - d.overtime_before)
+    FROM rollup r JOIN day_norm d ON d.employee_id = r.employee_id
+    WHERE e.id = r.employee_id AND r.overtime_seconds <> d.overtime_before
+)
+UPDATE online_status o
+SET is_online = FALSE, session_id = NULL, updated_at = c.ended_at
+FROM closed c
+WHERE o.employee_id = c.employee_id
+RETURNING o.employee_id;
 """
-SELECT_ACTIVE_SESSION = """
-SELECT id FROM work_sessions
-WHERE employee_id = %s AND ended_at IS NULL
-ORDER BY started_at DESC LIMIT 1;
+PUNCH_START_BREAK = """
+WITH state AS (
+    SELECT o.employee_id, o.session_id, p.at FROM online_status o
+    JOIN unnest(%s::int[], %s::timestamp[]) AS p(employee_id, at) ON p.employee_id = o.employee_id
+    WHERE o.session_id IS NOT NULL AND o.break_id IS NULL AND o.is_online
+    ORDER BY o.employee_id
+    FOR UPDATE OF o
+), opened AS (
+    INSERT INTO breaks (session_id, started_at)
+    SELECT session_id, at FROM state
+    RETURNING id, session_id, started_at
+)
+UPDATE online_status o
+SET is_online = FALSE, break_id = b.id, updated_at = b.started_at
+FROM opened b JOIN state s ON s.session_id = b.session_id
+WHERE o.employee_id = s.employee_id
+RETURNING o.employee_id;
 """
-
-INSERT_BREAK = """
-INSERT INTO breaks (session_id, started_at)
-VALUES (%s, %s);
+PUNCH_END_BREAK = """
+WITH state AS (
+    SELECT o.employee_id, o.break_id, p.at FROM online_status o
+    JOIN unnest(%s::int[], %s::timestamp[]) AS p(employee_id, at) ON p.employee_id = o.employee_id
+    WHERE o.break_id IS NOT NULL
+    ORDER BY o.employee_id
+    FOR UPDATE OF o
+), closed AS (
+    UPDATE breaks b
+    SET ended_at = s.at, duration = s.at - b.started_at
+    FROM state s
+    WHERE b.id = s.break_id
+    RETURNING b.id, b.session_id, b.ended_at, b.duration
+), rollup AS (
+    INSERT INTO daily_work_totals AS t (employee_id, day, break_seconds)
+    SELECT w.employee_id, w.started_at::date, EXTRACT(EPOCH FROM c.duration)
+    FROM closed c JOIN work_sessions w ON w.id = c.session_id
+    ON CONFLICT (employee_id, day) DO UPDATE
+    SET break_seconds = t.break_seconds + EXCLUDED.break_seconds
+)
+UPDATE online_status o
+SET is_online = TRUE, break_id = NULL, updated_at = c.ended_at
+FROM closed c JOIN state s ON s.break_id = c.id
+WHERE o.employee_id = s.employee_id
+RETURNING o.employee_id;
 """
-UPDATE_BREAK_END = """
-UPDATE breaks
-SET ended_at = %s, duration = %s - started_at
-WHERE id = %s;
+
+# punch kinds, in the order apply_punches runs them
+START_WORK = "start_work"
+START_BREAK = "start_break"
+END_BREAK = "end_break"
+END_WORK = "end_work"
+PUNCH_STATEMENTS = {
+    START_WORK: PUNCH_START_WORK,
+    START_BREAK: PUNCH_START_BREAK,
+    END_BREAK: PUNCH_END_BREAK,
+    END_WORK: PUNCH_END_WORK,
+}
+# whether the employee is online once the punch is applied
+PUNCH_ONLINE = {
+    START_WORK: True,
+    START_BREAK: False,
+    END_BREAK: True,
+    END_WORK: False,
+}
+
+# Closes, in one statement, up to %s sessions opened before the cut-off that
+# nobody ended, skipping employees whose punch holds their row right now. Not
+# only the session online_status points to ("current") but also older open
+# ones it lost track of, so none of them pins get_report_cutoff forever. A
+# session on a break ends when the break started and the break with no
+# length; otherwise it gets the day's norm, and no less than its last break,
+# but never runs into the employee's next session. Open breaks of sessions
+# that are already closed, up to %s of them, are ended with no length too.
+# Everything closed is flagged auto_closed and settled into the rollup like
+# PUNCH_END_WORK. Returns ('session' or 'break', employee_id, telegram_id,
+# started_at, ended_at, current) rows.
+AUTO_CLOSE_SESSIONS = """
+WITH state AS (
+    SELECT w.id AS session_id, w.employee_id, w.started_at, o.session_id IS NOT DISTINCT FROM w.id AS current
+    FROM work_sessions w
+    JOIN online_status o ON o.employee_id = w.employee_id
+    WHERE w.ended_at IS NULL AND w.started_at < %s
+    ORDER BY w.employee_id, w.id
+    LIMIT %s
+    FOR UPDATE OF o SKIP LOCKED
+), day_norm AS (
+    SELECT s.*, s.started_at::date AS day,
+           COALESCE(t.overtime_seconds, 0) AS overtime_before,
+           work_norm_seconds(s.started_at::date, cal.is_working, COALESCE(n.daily_seconds, dn.daily_seconds),
+                             COALESCE(n.weekend_days, dn.weekend_days)) AS norm
+    FROM state s
+    JOIN employees e ON e.id = s.employee_id
+    LEFT JOIN work_norms n ON n.division_id = e.division_id
+    LEFT JOIN work_norms dn ON dn.division_id IS NULL
+    LEFT JOIN work_calendar cal ON cal.day = s.started_at::date
+    LEFT JOIN daily_work_totals t ON t.employee_id = s.employee_id AND t.day = s.started_at::date
+), ends AS (
+    SELECT d.*, LEAST(
+               %s::timestamp,
+               (SELECT MIN(l.started_at) FROM work_sessions l
+                WHERE l.employee_id = d.employee_id AND (l.started_at, l.id) > (d.started_at, d.session_id)),
+               COALESCE(
+                   (SELECT MIN(b.started_at) FROM breaks b WHERE b.session_id = d.session_id AND b.ended_at IS NULL),
+                   GREATEST(d.started_at + make_interval(secs => COALESCE(d.norm, 0)),
+                            (SELECT MAX(b.ended_at) FROM breaks b WHERE b.session_id = d.session_id))
+               )) AS at
+    FROM day_norm d
+), orphan_breaks AS (
+    SELECT b.id FROM breaks b
+    JOIN work_sessions w ON w.id = b.session_id
+    LEFT JOIN online_status o ON o.employee_id = w.employee_id
+    WHERE b.ended_at IS NULL AND w.ended_at IS NOT NULL AND b.started_at < %s
+      AND o.break_id IS DISTINCT FROM b.id
+    ORDER BY b.id
+    LIMIT %s
+    FOR UPDATE OF b SKIP LOCKED
+), breaks_closed AS (
+    UPDATE breaks b
+    SET ended_at = b.started_at, duration = INTERVAL '0', auto_closed = TRUE
+    WHERE b.ended_at IS NULL
+      AND (b.session_id IN (SELECT session_id FROM ends) OR b.id IN (SELECT id FROM orphan_breaks))
+    RETURNING b.id, b.session_id, b.started_at, b.ended_at
+), closed AS (
+    UPDATE work_sessions w
+    SET ended_at = x.at, duration = x.at - w.started_at, auto_closed = TRUE
+    FROM ends x
+    WHERE w.id = x.session_id AND w.ended_at IS NULL
+    RETURNING w.id, w.employee_id, w.started_at, w.ended_at, w.duration
+), per_day AS (
+    -- an employee's sessions of one day go into their rollup row at once
+    SELECT x.employee_id, x.day, SUM(EXTRACT(EPOCH FROM c.duration)) AS worked, COUNT(*) AS sessions,
+           MIN(x.norm) AS norm, MIN(x.overtime_before) AS overtime_before
+    FROM closed c JOIN ends x ON x.session_id = c.id
+    GROUP BY x.employee_id, x.day
+), rollup AS (
+    INSERT INTO daily_work_totals AS t (employee_id, day, worked_seconds, session_count, norm_seconds, overtime_seconds)
+    SELECT employee_id, day, worked, sessions, norm, GREATEST(0, worked - norm) FROM per_day
+    ON CONFLICT (employee_id, day) DO UPDATE
+    SET worked_seconds = t.worked_seconds + EXCLUDED.worked_seconds,
+        session_count = t.session_count + EXCLUDED.session_count,
+        norm_seconds = EXCLUDED.norm_seconds,
+        overtime_seconds = GREATEST(0, t.worked_seconds + EXCLUDED.worked_seconds - t.break_seconds - EXCLUDED.norm_seconds)
+    RETURNING t.employee_id, t.day, t.overtime_seconds
+), accrued AS (
+    UPDATE employees e
+    SET overtime = e.overtime + make_interval(secs => a.seconds)
+    FROM (
+        SELECT r.employee_id, SUM(r.overtime_seconds - d.overtime_before) AS seconds
+        FROM rollup r JOIN per_day d ON d.employee_id = r.employee_id AND d.day = r.day
+        GROUP BY r.employee_id
+    ) a
+    WHERE e.id = a.employee_id AND a.seconds <> 0
+), reset AS (
+    UPDATE online_status o
+    SET is_online = FALSE, session_id = NULL, break_id = NULL, updated_at = c.ended_at
+    FROM closed c JOIN ends x ON x.session_id = c.id
+    WHERE o.employee_id = c.employee_id AND x.current
+)
+SELECT 'session', c.employee_id, e.telegram_id, c.started_at, c.ended_at, x.current
+FROM closed c
+JOIN ends x ON x.session_id = c.id
+JOIN employees e ON e.id = c.employee_id
+UNION ALL
+SELECT 'break', w.employee_id, e.telegram_id, b.started_at, b.ended_at, FALSE
+FROM breaks_closed b
+JOIN work_sessions w ON w.id = b.session_id
+JOIN employees e ON e.id = w.employee_id;
 """
 
-SELECT_COLLEAGUES = """
-SELECT e.last_name, e.first_name
+SELECT_PRESENCE = """
+SELECT e.id, e.last_name, e.first_name, e.department_id, e.division_id, COALESCE(o.is_online, FALSE)
 FROM employees e
-JOIN online_status o ON e.id = o.employee_id
-WHERE o.is_online = TRUE
-  AND e.department_id = %s
-  AND e.division_id = %s;
+LEFT JOIN online_status o ON e.id = o.employee_id
 """
+SELECT_PRESENCE_MEMBER = SELECT_PRESENCE + "WHERE e.id = %s;"
 
 AVG_WORK_TIME = """
 SELECT AVG(EXTRACT(EPOCH FROM duration)) AS avg_seconds
 FROM work_sessions
 WHERE employee_id = %s
-  AND started_at >= NOW() - INTERVAL %s
+  AND started_at >= NOW() - %s::interval
   AND duration IS NOT NULL;
 """
 
+# daily_work_totals is maintained by the punch statements: one row per
+# employee and day (the day a session started) with closed-session time.
+SELECT_WORK_STATS = """
+SELECT
+    COALESCE(SUM(worked_seconds) FILTER (WHERE day = %s), 0) AS today_secs,
+    COALESCE(AVG(worked_seconds) FILTER (WHERE day >= %s), 0) AS week_avg,
+    COALESCE(AVG(worked_seconds) FILTER (WHERE day >= %s), 0) AS month_avg
+FROM daily_work_totals
+WHERE employee_id = %s
+  AND day >= LEAST(%s::date, %s::date) AND day <= %s
+  AND session_count > 0;
+"""
+
+# per-employee totals of a period: one row per employee with a closed shift
+SELECT_DIVISION_REPORT = """
+SELECT
+    e.id,
+    e.last_name || ' ' || e.first_name AS full_name,
+    COUNT(*) AS shifts,
+    SUM(t.worked_seconds) AS worked_seconds,
+    SUM(t.overtime_seconds) AS overtime_seconds
+FROM daily_work_totals t
+JOIN employees e ON t.employee_id = e.id
+WHERE t.day >= %s AND t.day < %s
+  AND t.session_count > 0
+  AND e.department_id = %s
+  AND e.division_id = %s
+GROUP BY e.id, full_name
+ORDER BY full_name, e.id;
+"""
+SELECT_DIVISION_DAYS = """
+SELECT
+    e.last_name || ' ' || e.first_name AS full_name,
+    t.day,
+    t.worked_seconds,
+    t.break_seconds,
+    t.session_count
+FROM daily_work_totals t
+JOIN employees e ON t.employee_id = e.id
+WHERE t.day >= %s AND t.day < %s
+  AND e.department_id = %s
+  AND e.division_id = %s
+ORDER BY full_name, e.id, t.day;
+"""
+# rollup rows are keyed by the session start day, so a day stays open for as
+# long as a session started on it is still running
+SELECT_OPEN_SESSION_START = """
+SELECT MIN(w.started_at)::date
+FROM work_sessions w
+JOIN employees e ON w.employee_id = e.id
+WHERE w.ended_at IS NULL
+  AND e.department_id = %s
+  AND e.division_id = %s;
+"""
+
+# Rebuilds the rollup for [start, end] from the raw rows; NULL bounds mean the
+# whole history. The table lock holds back concurrent punch upserts until the
+# rebuilt rows are committed, so none of them is lost or counted twice.
+LOCK_DAILY_TOTALS = "LOCK TABLE daily_work_totals IN EXCLUSIVE MODE;"
+DELETE_DAILY_TOTALS = """
+DELETE FROM daily_work_totals
+WHERE day >= COALESCE(%s::date, '-infinity'::date)
+  AND day <= COALESCE(%s::date, 'infinity'::date);
+"""
+INSERT_DAILY_TOTALS = """
+INSERT INTO daily_work_totals (employee_id, day, worked_seconds, break_seconds, session_count)
+SELECT
+    w.employee_id,
+    w.started_at::date,
+    COALESCE(SUM(EXTRACT(EPOCH FROM w.duration)), 0),
+    COALESCE(SUM(b.secs), 0),
+    COUNT(w.duration)
+FROM work_sessions w
+LEFT JOIN LATERAL (
+    SELECT SUM(EXTRACT(EPOCH FROM duration)) AS secs
+    FROM breaks WHERE session_id = w.id AND duration IS NOT NULL
+) b ON TRUE
+WHERE w.started_at >= COALESCE(%s::date, '-infinity'::date)
+  AND w.started_at < COALESCE(%s::date + 1, 'infinity'::date)
+GROUP BY w.employee_id, w.started_at::date
+HAVING COUNT(w.duration) > 0 OR SUM(b.secs) > 0;
+"""
+
+SELECT_DEPARTMENTS = "SELECT id, name FROM departments;"
+SELECT_DIVISIONS = """
+SELECT dv.department_id, dv.id, dv.name
+FROM divisions dv JOIN departments d ON dv.department_id = d.id;
+"""
+
 SELECT_EMPLOYEES_BY_DEP_DIV = """
 SELECT id, last_name || ' ' || first_name AS full_name
 FROM employees
 WHERE department_id = %s AND division_id = %s;
 """
 UPDATE_EMPLOYEE_ROLE = """
-UPDATE employees SET role = %s, updated_at = NOW() WHERE id = %s;
+UPDATE employees SET role = %s, updated_at = NOW() WHERE id = %s
+RETURNING telegram_id;
 """
 
-UPDATE_EMPLOYEE_OVERTIME = """
-UPDATE employees
-SET overtime = overtime + %s
-WHERE id = %s;
+# Overtime is worked time beyond the day's norm, never below zero, kept per
+# day in daily_work_totals; employees.overtime is the sum over all days.
+# Recomputing a range is one pass over the rollup and one over employees, for
+# one division (both NULL for everyone) at a time; the rollup must be locked.
+RECOMPUTE_DAILY_OVERTIME = """
+UPDATE daily_work_totals t
+SET norm_seconds = x.norm,
+    overtime_seconds = GREATEST(0, t.worked_seconds - t.break_seconds - x.norm)
+FROM (
+    SELECT t.employee_id, t.day,
+           work_norm_seconds(t.day, (SELECT is_working FROM work_calendar WHERE day = t.day),
+                             k.daily_seconds, k.weekend_days) AS norm
+    FROM daily_work_totals t
+    JOIN (
+        SELECT e.id, COALESCE(n.daily_seconds, dn.daily_seconds) AS daily_seconds,
+               COALESCE(n.weekend_days, dn.weekend_days) AS weekend_days
+        FROM employees e
+        LEFT JOIN work_norms n ON n.division_id = e.division_id
+        LEFT JOIN work_norms dn ON dn.division_id IS NULL
+        WHERE %s::int IS NULL OR (e.department_id = %s AND e.division_id = %s)
+    ) k ON k.id = t.employee_id
+    WHERE t.day >= COALESCE(%s::date, '-infinity'::date)
+      AND t.day <= COALESCE(%s::date, 'infinity'::date)
+) x
+WHERE t.employee_id = x.employee_id AND t.day = x.day
+  AND (t.norm_seconds IS DISTINCT FROM x.norm
+       OR t.overtime_seconds <> GREATEST(0, t.worked_seconds - t.break_seconds - x.norm))
+RETURNING t.employee_id;
+"""
+SYNC_EMPLOYEE_OVERTIME = """
+UPDATE employees e
+SET overtime = make_interval(secs => s.seconds)
+FROM (
+    SELECT e.id, COALESCE(SUM(t.overtime_seconds), 0) AS seconds
+    FROM employees e
+    LEFT JOIN daily_work_totals t ON t.employee_id = e.id
+    WHERE %s::int IS NULL OR (e.department_id = %s AND e.division_id = %s)
+    GROUP BY e.id
+) s
+WHERE e.id = s.id AND e.overtime <> make_interval(secs => s.seconds)
+RETURNING e.id;
 """
 
+UPSERT_WORK_NORM = """
+INSERT INTO work_norms (division_id, daily_seconds, weekend_days)
+VALUES (%s, %s, %s)
+ON CONFLICT ((COALESCE(division_id, 0))) DO UPDATE
+SET daily_seconds = EXCLUDED.daily_seconds, weekend_days = EXCLUDED.weekend_days;
+"""
+UPSERT_CALENDAR_DAY = """
+INSERT INTO work_calendar (day, is_working, note)
+VALUES (%s, %s, %s)
+ON CONFLICT (day) DO UPDATE
+SET is_working = EXCLUDED.is_working, note = EXCLUDED.note;
+"""
+DELETE_CALENDAR_DAY = "DELETE FROM work_calendar WHERE day = %s;"
+
 SELECT_EMPLOYEE_OVERTIME = """
 SELECT overtime FROM employees WHERE id = %s;
 """
 
 INSERT_REMINDER = """
-INSERT INTO reminders (employee_id, remind_at, message)
-VALUES (%s, %s, %s)
+INSERT INTO reminders (employee_id, remind_at, message, rule)
+VALUES (%s, %s, %s, %s)
 RETURNING id, remind_at, message;
 """
 
 SELECT_REMINDERS_BY_EMP = """
-SELECT id, remind_at, message
+SELECT id, remind_at, message, rule
 FROM reminders
-WHERE employee_id = %s
+WHERE employee_id = %s AND (delivered_at IS NULL OR rule IS NOT NULL)
 ORDER BY remind_at ASC;
 """
 
+# keyset page over the pending-reminders index
+SELECT_PENDING_REMINDERS = """
+SELECT remind_at, id
+FROM reminders
+WHERE delivered_at IS NULL
+  AND remind_at < %s
+  AND (remind_at, id) > (%s, %s)
+ORDER BY remind_at, id
+LIMIT %s;
+"""
+# Marks reminders delivered before they are sent. Only rows still pending come
+# back, so a reminder deleted meanwhile or claimed by another process is skipped.
+CLAIM_REMINDERS = """
+UPDATE reminders r
+SET delivered_at = NOW()
+FROM employees e
+LEFT JOIN online_status o ON o.employee_id = e.id
+WHERE r.id = ANY(%s)
+  AND r.delivered_at IS NULL
+  -- the scheduler may hold an older time for a reminder moved later since
+  AND r.remind_at <= %s
+  AND e.id = r.employee_id
+RETURNING r.id, e.telegram_id, r.message, r.rule, r.remind_at, o.session_id IS NOT NULL;
+"""
+# recurring reminders go back to pending at their next occurrence
+REARM_REMINDERS = """
+UPDATE reminders r
+SET remind_at = v.next_at, delivered_at = NULL
+FROM unnest(%s::int[], %s::timestamp[]) AS v (id, next_at)
+WHERE r.id = v.id;
+"""
+RELEASE_REMINDER = "UPDATE reminders SET delivered_at = NULL WHERE id = %s;"
+
 DELETE_REMINDER_BY_ID = """
 DELETE FROM reminders WHERE id = %s;
 """
 
+SELECT_BOT_STATE = "SELECT namespace, key, value FROM bot_state;"
+UPSERT_BOT_STATE = """
+INSERT INTO bot_state (namespace, key, value, updated_at)
+SELECT n, k, v, NOW() FROM unnest(%s::text[], %s::text[], %s::bytea[]) AS u(n, k, v)
+ON CONFLICT (namespace, key) DO UPDATE
+SET value = EXCLUDED.value, updated_at = EXCLUDED.updated_at;
+"""
+DELETE_BOT_STATE = """
+DELETE FROM bot_state b
+USING unnest(%s::text[], %s::text[]) AS u(n, k)
+WHERE b.namespace = u.n AND b.key = u.k;
+"""
+
 
-def get_employee_by_telegram(telegram_id: int) -> Optional[Tuple[int, str, int, int]]:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(SELECT_EMPLOYEE_BY_TG, (telegram_id,))
-    row = cur.fetchone()
-    release_conn(conn)
-    return row
+def get_employee_by_telegram(telegram_id: int) -> Optional[Employee]:
+    emp = employee_cache.get(telegram_id)
+    if emp is not None:
+        return emp
+    # a change notified while this reads must not leave the old row cached
+    generation = employee_cache.generation()
+    with connection() as conn:
+        rows = conn.run(SELECT_EMPLOYEE_BY_TG, (telegram_id,))
+    if not rows:
+        return None
+    emp = Employee(*rows[0])
+    employee_cache.set(telegram_id, emp, generation)
+    return emp
+
+
+def invalidate_employee(telegram_id: int) -> None:
+    employee_cache.pop(telegram_id)
 
 
 def create_employee(telegram_id: int, last_name: str, first_name: str, patronymic: str,
                     department_id: int, division_id: int) -> Optional[int]:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(INSERT_EMPLOYEE, (telegram_id, last_name, first_name, patronymic, department_id, division_id))
-    res = cur.fetchone()
-    conn.commit()
-    if res:
-        emp_id = res[0]
-    else:
-        cur.execute(SELECT_EMPLOYEE_BY_TG, (telegram_id,))
-        emp_id = cur.fetchone()[0]
-    cur.execute(INSERT_ONLINE_STATUS, (emp_id, False))
-    conn.commit()
-    release_conn(conn)
+    with connection() as conn:
+        rows = conn.run(INSERT_EMPLOYEE, (telegram_id, last_name, first_name, patronymic, department_id, division_id))
+        if rows:
+            emp_id = rows[0][0]
+        else:
+            emp_id = conn.run(SELECT_EMPLOYEE_BY_TG, (telegram_id,))[0][0]
+        conn.run(INSERT_ONLINE_STATUS, (emp_id, False))
+        conn.commit()
+    invalidate_employee(telegram_id)
     return emp_id
 
 
 def set_online_status(employee_id: int, is_online: bool):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(UPDATE_ONLINE_STATUS, (is_online, employee_id))
-    conn.commit()
-    release_conn(conn)
+    with connection() as conn:
+        conn.run(UPDATE_ONLINE_STATUS, (is_online, employee_id))
+        conn.commit()
+
+
+def _mark_presence(employee_id: int, online: bool):
+    if not presence.known(employee_id):
+        with connection() as conn:
+            rows = conn.run(SELECT_PRESENCE_MEMBER, (employee_id,))
+        if not rows:
+            return
+        presence.add_member(*rows[0][:5])
+    presence.set_online(employee_id, online)
+
+
+def write_punches(punches: List[Tuple[str, int, datetime.datetime]]) -> set:
+    # (kind, employee_id, at) with each employee at most once; every kind is
+    # one multi-row statement and the whole batch one commit. Returns the
+    # accepted (kind, employee_id) pairs once they are committed.
+    by_kind = {}
+    for kind, employee_id, at in punches:
+        ids, times = by_kind.setdefault(kind, ([], []))
+        ids.append(employee_id)
+        times.append(at)
+    accepted = set()
+    # a single statement is atomic on its own, so skip BEGIN/COMMIT round trips
+    with connection(autocommit=len(by_kind) == 1) as conn:
+        for kind, sql in PUNCH_STATEMENTS.items():
+            if kind in by_kind:
+                accepted.update((kind, row[0]) for row in conn.run(sql, by_kind[kind]))
+        if not conn.autocommit:
+            conn.commit()
+    return accepted
+
+
+def settle_punches(punches: List[Tuple[str, int, datetime.datetime]], accepted: set) -> List[str]:
+    # the outcome of every punch and this process's caches brought up to date;
+    # the punches are committed by now, so a cache that cannot be updated is
+    # only logged (the presence event of the commit corrects it)
+    outcomes = []
+    for kind, employee_id, at in punches:
+        if (kind, employee_id) not in accepted:
+            outcomes.append(PUNCH_REJECTED)
+            continue
+        if kind == END_WORK:
+            stats_cache.pop(employee_id)
+        try:
+            _mark_presence(employee_id, PUNCH_ONLINE[kind])
+        except Exception:
+            logger.exception("presence of employee %s not updated", employee_id)
+        outcomes.append(PUNCH_OK)
+    return outcomes
+
+
+def apply_punches(punches: List[Tuple[str, int, datetime.datetime]]) -> List[str]:
+    return settle_punches(punches, write_punches(punches))
+
+
+def auto_close_sessions(cutoff: datetime.datetime, now: datetime.datetime,
+                        limit: int) -> Tuple[list, int]:
+    # (employee_id, telegram_id, started_at, ended_at, current) of the closed
+    # sessions, and how many breaks were closed
+    with connection(autocommit=True) as conn:
+        rows = conn.run(AUTO_CLOSE_SESSIONS, (cutoff, limit, now, cutoff, limit))
+    sessions = [tuple(row[1:]) for row in rows if row[0] == "session"]
+    for employee_id, _, _, _, current in sessions:
+        stats_cache.pop(employee_id)
+        if current:
+            _mark_presence(employee_id, False)
+    return sessions, len(rows) - len(sessions)
+
+
+def rebuild_presence():
+    with connection() as conn:
+        presence.rebuild(conn.run(SELECT_PRESENCE))
+
+
+def refresh_presence_member(employee_id: int):
+    with connection() as conn:
+        rows = conn.run(SELECT_PRESENCE_MEMBER, (employee_id,))
+    presence.remove(employee_id)
+    if rows:
+        presence.add_member(*rows[0][:5])
+        presence.set_online(employee_id, rows[0][5])
 
 
-def start_work_session(employee_id: int) -> None:
-    now = datetime.datetime.now()
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(INSERT_WORK_SESSION, (employee_id, now))
-    cur.execute(UPDATE_ONLINE_STATUS, (True, employee_id))
-    conn.commit()
-    release_conn(conn)
+def get_average_work_time(employee_id: int, interval: str) -> float:
+    with connection() as conn:
+        return conn.run(AVG_WORK_TIME, (employee_id, interval))[0][0] or 0.0
+
+
+def get_cached_work_stats(employee_id: int, today: datetime.date) -> Optional[Tuple[float, float, float]]:
+    cached = stats_cache.get(employee_id)
+    if cached and cached[0] == today:
+        return cached[1]
+    return None
+
+
+def get_work_stats(employee_id: int, today: datetime.date) -> Tuple[float, float, float]:
+    # (seconds today, daily average since Monday, daily average since the 1st)
+    stats = get_cached_work_stats(employee_id, today)
+    if stats is not None:
+        return stats
+    monday = today - datetime.timedelta(days=today.weekday())
+    first_of_month = today.replace(day=1)
+    # a session closed while this reads must not leave the older figures cached
+    generation = stats_cache.generation()
+    with connection() as conn:
+        row = conn.run(SELECT_WORK_STATS, (today, monday, first_of_month, employee_id,
+                                           monday, first_of_month, today))[0]
+    stats = tuple(float(v) for v in row)
+    stats_cache.set(employee_id, (today, stats), generation)
+    return stats
+
+
+def get_division_report(department_id: int, division_id: int,
+                        start_date: datetime.date, end_date: datetime.date) -> List[tuple]:
+    # (employee_id, full_name, shifts, worked_seconds, overtime_seconds)
+    with connection() as conn:
+        # half-open [start, end + 1 day) range over the rollup primary key
+        end = end_date + datetime.timedelta(days=1)
+        rows = conn.run(SELECT_DIVISION_REPORT, (start_date, end, department_id, division_id))
+    return [(eid, name, shifts, float(worked), float(overtime)) for eid, name, shifts, worked, overtime in rows]
+
+
+def stream_division_days(conn, department_id: int, division_id: int,
+                         start_date: datetime.date, end_date: datetime.date, chunk_size: int):
+    end = end_date + datetime.timedelta(days=1)
+    return stream(conn, SELECT_DIVISION_DAYS, (start_date, end, department_id, division_id), chunk_size)
+
+
+def rebuild_daily_totals(start_date: Optional[datetime.date] = None,
+                         end_date: Optional[datetime.date] = None) -> int:
+    with connection() as conn:
+        conn.run(LOCK_DAILY_TOTALS)
+        conn.run(DELETE_DAILY_TOTALS, (start_date, end_date))
+        cur = conn.cursor()
+        with timed_statement(INSERT_DAILY_TOTALS, (start_date, end_date)):
+            cur.execute(INSERT_DAILY_TOTALS, (start_date, end_date))
+        count = cur.rowcount
+        # the rebuilt days start without overtime
+        _recompute_overtime(conn, start_date, end_date, None, None)
+        events.publish(conn, events.REPORTS, department_id=None, division_id=None)
+        conn.commit()
+    invalidate_reports()
+    return count
+
+
+def _recompute_overtime(conn, start_date, end_date, department_id, division_id) -> Tuple[int, int]:
+    division = (division_id, department_id, division_id)
+    days = conn.run(RECOMPUTE_DAILY_OVERTIME, division + (start_date, end_date))
+    employees = conn.run(SYNC_EMPLOYEE_OVERTIME, division)
+    return len(days), len(employees)
+
+
+def recompute_overtime(start_date: Optional[datetime.date] = None, end_date: Optional[datetime.date] = None,
+                       department_id: Optional[int] = None, division_id: Optional[int] = None) -> Tuple[int, int]:
+    # after a norm or calendar change; NULL bounds mean the whole history and
+    # no division means everyone. Returns the changed days and employees.
+    with connection() as conn:
+        conn.run(LOCK_DAILY_TOTALS)
+        changed = _recompute_overtime(conn, start_date, end_date, department_id, division_id)
+        events.publish(conn, events.REPORTS, department_id=department_id, division_id=division_id)
+        conn.commit()
+    invalidate_reports(department_id, division_id)
+    return changed
+
+
+def get_report_cutoff(department_id: int, division_id: int, today: datetime.date) -> datetime.date:
+    # first day of the division whose totals may still change
+    with connection() as conn:
+        rows = conn.run(SELECT_OPEN_SESSION_START, (department_id, division_id))
+    oldest_open = rows[0][0] if rows else None
+    return min(today, oldest_open) if oldest_open else today
+
+
+def invalidate_reports(department_id: Optional[int] = None, division_id: Optional[int] = None):
+    if department_id is None:
+        report_cache.clear()
+    else:
+        report_cache.discard_where(lambda key: key[:2] == (department_id, division_id))
 
 
-def end_work_session(employee_id: int) -> None:
-    now = datetime.datetime.now()
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(UPDATE_WORK_SESSION_END, (now, now, employee_id))
-    cur.execute(UPDATE_ONLINE_STATUS, (False, employee_id))
-    conn.commit()
-    release_conn(conn)
-
-
-def start_break(employee_id: int) -> None:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(SELECT_ACTIVE_SESSION, (employee_id,))
-    session_id = cur.fetchone()[0]
-    now = datetime.datetime.now()
-    cur.execute(INSERT_BREAK, (session_id, now))
-    cur.execute(UPDATE_ONLINE_STATUS, (False, employee_id))
-    conn.commit()
-    release_conn(conn)
-
-
-def end_break(employee_id: int) -> None:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(SELECT_ACTIVE_SESSION, (employee_id,))
-    session_id = cur.fetchone()[0]
-    cur.execute("""
-        SELECT id FROM breaks WHERE session_id = %s AND ended_at IS NULL
-        ORDER BY started_at DESC LIMIT 1;
-    """, (session_id,))
-    break_id = cur.fetchone()[0]
-    now = datetime.datetime.now()
-    cur.execute(UPDATE_BREAK_END, (now, now, break_id))
-    cur.execute(UPDATE_ONLINE_STATUS, (True, employee_id))
-    conn.commit()
-    release_conn(conn)
+def apply_employee_event(event: dict):
+    invalidate_employee(event["telegram_id"])
+    refresh_presence_member(event["id"])
 
 
-def get_colleagues(department_id: int, division_id: int) -> List[Tuple[str, str]]:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(SELECT_COLLEAGUES, (department_id, division_id))
-    rows = cur.fetchall()
-    release_conn(conn)
-    return rows
+def apply_presence_event(event: dict):
+    # only a closed session changes the stats; events of a trigger older than
+    # migration 13 do not say, so they still drop them
+    if event.get("session_closed", True):
+        stats_cache.pop(event["employee_id"])
+    _mark_presence(event["employee_id"], event["online"])
 
 
-def get_average_work_time(employee_id: int, interval: str) -> float:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(AVG_WORK_TIME, (employee_id, interval))
-    res = cur.fetchone()[0] or 0.0
-    release_conn(conn)
-    return res
+def apply_reports_event(event: dict):
+    invalidate_reports(event.get("department_id"), event.get("division_id"))
+
+
+def resync_caches():
+    employee_cache.clear()
+    stats_cache.clear()
+    invalidate_reports()
+    rebuild_presence()
+
+
+def get_directory():
+    with connection() as conn:
+        deps = conn.run(SELECT_DEPARTMENTS)
+        divs = conn.run(SELECT_DIVISIONS)
+    return deps, divs
 
 
 def list_employees(department_id: int, division_id: int) -> List[Tuple[int, str]]:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(SELECT_EMPLOYEES_BY_DEP_DIV, (department_id, division_id))
-    rows = cur.fetchall()
-    release_conn(conn)
-    return rows
+    with connection() as conn:
+        return conn.run(SELECT_EMPLOYEES_BY_DEP_DIV, (department_id, division_id))
 
 
 def set_employee_role(employee_id: int, role: str) -> None:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(UPDATE_EMPLOYEE_ROLE, (role, employee_id))
-    conn.commit()
-    release_conn(conn)
-
-def create_reminder(employee_id: int, remind_at: datetime.datetime, message: str) -> Tuple[int, datetime.datetime, str]:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(INSERT_REMINDER, (employee_id, remind_at, message))
-    row = cur.fetchone()
-    conn.commit()
-    release_conn(conn)
+    with connection() as conn:
+        rows = conn.run(UPDATE_EMPLOYEE_ROLE, (role, employee_id))
+        conn.commit()
+    for (telegram_id,) in rows:
+        invalidate_employee(telegram_id)
+
+def create_reminder(employee_id: int, remind_at: datetime.datetime, message: str,
+                    rule: Optional[str] = None) -> Tuple[int, datetime.datetime, str]:
+    with connection() as conn:
+        row = conn.run(INSERT_REMINDER, (employee_id, remind_at, message, rule))[0]
+        conn.commit()
     return row
 
-def get_reminders(employee_id: int) -> List[Tuple[int, datetime.datetime, str]]:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(SELECT_REMINDERS_BY_EMP, (employee_id,))
-    rows = cur.fetchall()
-    release_conn(conn)
-    return rows
+def get_reminders(employee_id: int) -> List[Tuple[int, datetime.datetime, str, Optional[str]]]:
+    with connection() as conn:
+        return conn.run(SELECT_REMINDERS_BY_EMP, (employee_id,))
 
 def delete_reminder(reminder_id: int):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(DELETE_REMINDER_BY_ID, (reminder_id,))
-    conn.commit()
-    release_conn(conn)
+    with connection() as conn:
+        conn.run(DELETE_REMINDER_BY_ID, (reminder_id,))
+        conn.commit()
+
+def load_pending_reminders(until: datetime.datetime, after: Tuple[datetime.datetime, int],
+                           limit: int) -> List[Tuple[datetime.datetime, int]]:
+    with connection() as conn:
+        return conn.run(SELECT_PENDING_REMINDERS, (until, after[0], after[1], limit))
+
+def claim_reminders(reminder_ids: List[int]) -> List[Tuple[int, int, str]]:
+    # Returns (id, telegram_id, message) to send. Recurring reminders are put
+    # back at their next occurrence in the same transaction; session ones that
+    # find the employee off work stay parked until the next "Начал". Ids not
+    # due yet are left alone and come back with the next refill.
+    now = datetime.datetime.now()
+    due, rearm_ids, rearm_at = [], [], []
+    with connection() as conn:
+        for rid, telegram_id, message, rule, remind_at, in_session in conn.run(CLAIM_REMINDERS, (reminder_ids, now)):
+            if session_minutes(rule) and not in_session:
+                continue
+            due.append((rid, telegram_id, message))
+            if rule:
+                rearm_ids.append(rid)
+                rearm_at.append(next_fire(rule, remind_at, now))
+        if rearm_ids:
+            conn.run(REARM_REMINDERS, (rearm_ids, rearm_at))
+        conn.commit()
+    return due
+
+def release_reminder(reminder_id: int):
+    with connection(autocommit=True) as conn:
+        conn.run(RELEASE_REMINDER, (reminder_id,))
+
+def load_bot_state() -> List[Tuple[str, str, bytes]]:
+    with connection() as conn:
+        return conn.run(SELECT_BOT_STATE)
+
+
+def save_bot_state(upserts: List[Tuple[str, str, bytes]], deletes: List[Tuple[str, str]]):
+    # one transaction and at most two statements for a whole batch
+    with connection() as conn:
+        if upserts:
+            namespaces, keys, values = zip(*upserts)
+            conn.run(UPSERT_BOT_STATE, (list(namespaces), list(keys), list(values)))
+        if deletes:
+            namespaces, keys = zip(*deletes)
+            conn.run(DELETE_BOT_STATE, (list(namespaces), list(keys)))
+        conn.commit()
+
+
+def set_work_norm(division_id: Optional[int], daily_seconds: float, weekend_days: List[int]):
+    # division_id None sets the default norm
+    with connection() as conn:
+        conn.run(UPSERT_WORK_NORM, (division_id, daily_seconds, weekend_days))
+        conn.commit()
+
+
+def set_calendar_day(day: datetime.date, is_working: Optional[bool], note: Optional[str] = None):
+    # is_working None returns the day to the weekly rule
+    with connection() as conn:
+        if is_working is None:
+            conn.run(DELETE_CALENDAR_DAY, (day,))
+        else:
+            conn.run(UPSERT_CALENDAR_DAY, (day, is_working, note))
+        conn.commit()
+
 
 def get_employee_overtime(employee_id: int) -> datetime.timedelta:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(SELECT_EMPLOYEE_OVERTIME, (employee_id,))
-    row = cur.fetchone()
-    release_conn(conn)
-    return row[0] if row and row[0] is not None else datetime.timedelta(0)
\ No newline at end of file
+    with connection() as conn:
+        rows = conn.run(SELECT_EMPLOYEE_OVERTIME, (employee_id,))
+    return rows[0][0] if rows and rows[0][0] is not None else datetime.timedelta(0)
+
+
+# query timings are recorded under the names of the constants above
+name_statements(globals())
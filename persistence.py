@@ -0,0 +1,134 @@
+import asyncio
+import json
+import logging
+import pickle
+from collections import defaultdict
+
+from telegram.ext import BasePersistence, PersistenceInput
+from config import PERSISTENCE_FLUSH_SECONDS, PERSISTENCE_UPDATE_SECONDS
+from database import run_db
+from models import load_bot_state, save_bot_state
+
+logger = logging.getLogger(__name__)
+
+USER_DATA = "user_data"
+CHAT_DATA = "chat_data"
+CONVERSATION = "conversation:"  # followed by the ConversationHandler name
+
+
+class PostgresPersistence(BasePersistence):
+    # user_data, chat_data and conversation states live in the bot_state
+    # table, pickled, one row per user, chat or conversation key. Everything
+    # is read once on startup. Changes are queued and written together, one
+    # transaction per PERSISTENCE_FLUSH_SECONDS, and a value that pickles to
+    # what was last written is not queued at all.
+
+    def __init__(self, update_interval: float = PERSISTENCE_UPDATE_SECONDS,
+                 flush_delay: float = PERSISTENCE_FLUSH_SECONDS):
+        super().__init__(store_data=PersistenceInput(bot_data=False, callback_data=False),
+                         update_interval=update_interval)
+        self.flush_delay = flush_delay
+        self._loaded = None
+        self._written = {}   # (namespace, key) -> pickled value in the table
+        self._pending = {}   # (namespace, key) -> pickled value, or None to delete
+        self._flush_task = None
+
+    async def _load(self) -> dict:
+        if self._loaded is None:
+            loaded = defaultdict(dict)
+            for namespace, key, value in await run_db(load_bot_state):
+                self._written[(namespace, key)] = value
+                loaded[namespace][key] = pickle.loads(value)
+            self._loaded = loaded
+        return self._loaded
+
+    def _queue(self, namespace: str, key: str, value):
+        blob = None if value is None else pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if self._pending.get((namespace, key), self._written.get((namespace, key))) == blob:
+            return
+        self._pending[(namespace, key)] = blob
+        if self._flush_task is None:
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self.flush_delay)
+        finally:
+            self._flush_task = None
+        await self._write()
+
+    async def _write(self):
+        batch, self._pending = self._pending, {}
+        if not batch:
+            return
+        upserts = [(ns, key, blob) for (ns, key), blob in batch.items() if blob is not None]
+        deletes = [(ns, key) for (ns, key), blob in batch.items() if blob is None]
+        try:
+            await run_db(save_bot_state, upserts, deletes)
+        except Exception:
+            logger.exception("saving %d state changes failed, will retry", len(batch))
+            # anything changed since is newer than the failed batch
+            self._pending = {**batch, **self._pending}
+            if self._flush_task is None:
+                self._flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+            return
+        for item, blob in batch.items():
+            if blob is None:
+                self._written.pop(item, None)
+            else:
+                self._written[item] = blob
+
+    async def get_user_data(self) -> dict:
+        return {int(key): value for key, value in (await self._load())[USER_DATA].items()}
+
+    async def get_chat_data(self) -> dict:
+        return {int(key): value for key, value in (await self._load())[CHAT_DATA].items()}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        # conversation keys are tuples of chat and user ids, stored as JSON lists
+        stored = (await self._load())[CONVERSATION + name]
+        return {tuple(json.loads(key)): state for key, state in stored.items()}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        self._queue(CONVERSATION + name, json.dumps(list(key)), new_state)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        # an emptied dict is deleted, an empty one never written
+        self._queue(USER_DATA, str(user_id), data or None)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._queue(CHAT_DATA, str(chat_id), data or None)
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._queue(USER_DATA, str(user_id), None)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._queue(CHAT_DATA, str(chat_id), None)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    async def flush(self) -> None:
+        # on shutdown: whatever is queued goes out now
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self._write()
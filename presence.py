@@ -0,0 +1,72 @@
+import threading
+from typing import List, Tuple
+
+# Who is online, by (department_id, division_id). Every employee's division
+# and name are kept as well, so a punch, which only knows the employee id,
+# is applied without a query. Built from the database on startup and kept up
+# to date by the punch functions in models.py.
+_lock = threading.Lock()
+_members = {}  # employee_id -> (department_id, division_id, name)
+_online = {}   # (department_id, division_id) -> {employee_id: name}
+_sorted = {}   # (department_id, division_id) -> names in display order
+
+
+def _name(last_name: str, first_name: str) -> str:
+    return f"{last_name} {first_name}"
+
+
+def rebuild(rows):
+    # rows: (employee_id, last_name, first_name, department_id, division_id, is_online)
+    members, online = {}, {}
+    for employee_id, last_name, first_name, department_id, division_id, is_online in rows:
+        name = _name(last_name, first_name)
+        members[employee_id] = (department_id, division_id, name)
+        if is_online:
+            online.setdefault((department_id, division_id), {})[employee_id] = name
+    global _members, _online, _sorted
+    with _lock:
+        _members, _online, _sorted = members, online, {}
+
+
+def known(employee_id: int) -> bool:
+    return employee_id in _members
+
+
+def add_member(employee_id: int, last_name: str, first_name: str, department_id: int, division_id: int):
+    with _lock:
+        _members[employee_id] = (department_id, division_id, _name(last_name, first_name))
+
+
+def remove(employee_id: int):
+    # for an employee who was deleted, renamed or moved to another division
+    with _lock:
+        member = _members.pop(employee_id, None)
+        if member is not None:
+            key = member[:2]
+            if _online.get(key, {}).pop(employee_id, None) is not None:
+                _sorted.pop(key, None)
+
+
+def set_online(employee_id: int, online: bool):
+    with _lock:
+        member = _members.get(employee_id)
+        if member is None:
+            return
+        department_id, division_id, name = member
+        key = (department_id, division_id)
+        people = _online.setdefault(key, {})
+        if online:
+            people[employee_id] = name
+        else:
+            people.pop(employee_id, None)
+        _sorted.pop(key, None)
+
+
+def online_page(department_id: int, division_id: int, page: int, size: int) -> Tuple[List[str], int]:
+    # one page of names and the number of people online in the division
+    key = (department_id, division_id)
+    with _lock:
+        names = _sorted.get(key)
+        if names is None:
+            names = _sorted[key] = sorted(_online.get(key, {}).values())
+    return names[page * size:(page + 1) * size], len(names)
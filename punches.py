@@ -0,0 +1,82 @@
+import asyncio
+import datetime
+import logging
+from collections import deque
+
+from config import PUNCH_BATCH_DELAY_MS, PUNCH_BATCH_MAX, PUNCH_WRITE_BEHIND
+from database import run_db
+from models import apply_punches, settle_punches, write_punches
+
+logger = logging.getLogger(__name__)
+
+# With PUNCH_WRITE_BEHIND on, punches are not written one transaction each.
+# They queue here per employee and a single writer takes the oldest punch of
+# up to PUNCH_BATCH_MAX employees into one batch: one multi-row statement per
+# kind and one commit. A punch is answered once its batch has committed, so
+# the answer is as durable and as strictly checked as before; an employee's
+# next punch waits for the following batch, which keeps their order.
+_pending = {}  # employee_id -> deque of (kind, at, future), oldest first
+_wakeup = None
+_writer = None
+
+
+async def punch(kind: str, employee_id: int) -> str:
+    at = datetime.datetime.now()
+    if not PUNCH_WRITE_BEHIND:
+        return (await run_db(apply_punches, [(kind, employee_id, at)]))[0]
+
+    global _wakeup, _writer
+    if _writer is None or _writer.done():
+        _wakeup = asyncio.Event()
+        _writer = asyncio.get_running_loop().create_task(_write_batches())
+    future = asyncio.get_running_loop().create_future()
+    _pending.setdefault(employee_id, deque()).append((kind, at, future))
+    _wakeup.set()
+    return await future
+
+
+def _take_batch() -> list:
+    batch = []
+    for employee_id in list(_pending)[:PUNCH_BATCH_MAX]:
+        queue = _pending[employee_id]
+        kind, at, future = queue.popleft()
+        if not queue:
+            del _pending[employee_id]
+        batch.append((kind, employee_id, at, future))
+    return batch
+
+
+async def _write_batches():
+    while True:
+        await _wakeup.wait()
+        _wakeup.clear()
+        # the first press of a burst waits a moment for the others
+        await asyncio.sleep(PUNCH_BATCH_DELAY_MS / 1000)
+        while _pending:
+            batch = _take_batch()
+            punches = [(kind, emp, at) for kind, emp, at, _ in batch]
+            try:
+                accepted = await run_db(write_punches, punches)
+            except Exception:
+                # Nothing of the batch was committed. One bad punch or a lock
+                # conflict must not fail the others.
+                logger.exception("punch batch of %d failed, applying one by one", len(batch))
+                await _apply_singly(batch)
+                continue
+            # committed: from here on the punches are never written again
+            outcomes = await run_db(settle_punches, punches, accepted)
+            for (_, _, _, future), outcome in zip(batch, outcomes):
+                if not future.done():
+                    future.set_result(outcome)
+
+
+async def _apply_singly(batch: list):
+    for kind, employee_id, at, future in batch:
+        try:
+            outcome = (await run_db(apply_punches, [(kind, employee_id, at)]))[0]
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(outcome)
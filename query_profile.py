@@ -0,0 +1,184 @@
+import datetime
+import hashlib
+import json
+import logging
+import queue
+import re
+import threading
+import time
+
+from config import (
+    QUERY_PROFILE_SLOW_MS, QUERY_PROFILE_LOG, QUERY_PROFILE_EXPLAIN_SECONDS, QUERY_PROFILE_EXPLAIN_TIMEOUT_MS,
+)
+from database import add_query_hook, connect, statement_label
+
+logger = logging.getLogger(__name__)
+
+# With QUERY_PROFILE on, every statement run through the pool is reduced to a
+# fingerprint (its text with literals and parameters replaced by ?) and its
+# time added to that fingerprint's totals. A statement slower than
+# QUERY_PROFILE_SLOW_MS has its plan captured on a thread of its own and
+# appended to QUERY_PROFILE_LOG as one JSON object per line, at most once per
+# fingerprint every QUERY_PROFILE_EXPLAIN_SECONDS. Only plain SELECTs are
+# EXPLAIN ANALYZEd, in a read-only transaction that is rolled back; anything
+# that writes only gets its estimated plan, since ANALYZE would run it again.
+
+_COMMENTS = re.compile(r"--[^\n]*|/\*.*?\*/", re.S)
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_NUMBERS = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])")
+_PARAMS = re.compile(r"%s|\$\d+|:p\d+")
+_LISTS = re.compile(r"\?(?:\s*,\s*\?)+")
+_SPACE = re.compile(r"\s+")
+_WRITES = re.compile(r"\b(INSERT|UPDATE|DELETE|MERGE|LOCK|FOR\s+UPDATE|FOR\s+SHARE|PG_NOTIFY|NEXTVAL|SETVAL)\b", re.I)
+
+# how many distinct SQL texts keep their fingerprint cached
+MAX_CACHED_TEXTS = 10000
+# slow statements waiting for their plan; more are dropped
+MAX_QUEUED_PLANS = 100
+
+
+def normalize(sql: str) -> str:
+    sql = _COMMENTS.sub(" ", sql)
+    sql = _STRINGS.sub("?", sql)
+    sql = _PARAMS.sub("?", sql)
+    sql = _NUMBERS.sub("?", sql)
+    sql = _LISTS.sub("?", sql)
+    return _SPACE.sub(" ", sql).strip().rstrip(";").strip()
+
+
+class QueryStats:
+    __slots__ = ("fingerprint", "label", "text", "calls", "total", "max", "slow", "explained_at")
+
+    def __init__(self, fingerprint: str, label: str, text: str):
+        self.fingerprint = fingerprint
+        self.label = label
+        self.text = text
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.slow = 0
+        self.explained_at = None
+
+
+_fingerprints = {}  # SQL text -> (fingerprint, normalized text)
+_stats = {}         # fingerprint -> QueryStats
+_lock = threading.Lock()
+_plans = queue.Queue(MAX_QUEUED_PLANS)
+_explainer = None
+
+
+def fingerprint(sql: str):
+    cached = _fingerprints.get(sql)
+    if cached is None:
+        text = normalize(sql)
+        cached = (hashlib.sha1(text.encode()).hexdigest()[:16], text)
+        if len(_fingerprints) >= MAX_CACHED_TEXTS:
+            _fingerprints.clear()
+        _fingerprints[sql] = cached
+    return cached
+
+
+def record(sql: str, params, seconds: float):
+    # the database.add_query_hook hook; must never fail the statement itself
+    try:
+        key, text = fingerprint(sql)
+        slow = seconds * 1000 >= QUERY_PROFILE_SLOW_MS
+        explain = False
+        with _lock:
+            stats = _stats.get(key)
+            if stats is None:
+                stats = _stats[key] = QueryStats(key, statement_label(sql), text)
+            stats.calls += 1
+            stats.total += seconds
+            stats.max = max(stats.max, seconds)
+            if slow:
+                stats.slow += 1
+                now = time.monotonic()
+                if stats.explained_at is None or now - stats.explained_at >= QUERY_PROFILE_EXPLAIN_SECONDS:
+                    stats.explained_at = now
+                    explain = True
+        if explain:
+            _plans.put_nowait((key, stats.label, text, sql, params, seconds, datetime.datetime.now()))
+    except queue.Full:
+        pass
+    except Exception:
+        logger.exception("query profiler failed on %r", sql[:80])
+
+
+def top(n: int = 10, by: str = "total") -> list:
+    with _lock:
+        stats = [(s.fingerprint, s.label, s.text, s.calls, s.total, s.max, s.slow) for s in _stats.values()]
+    index = {"total": 4, "max": 5, "calls": 3, "slow": 6}[by]
+    return sorted(stats, key=lambda row: row[index], reverse=True)[:n]
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+def read_only(sql: str) -> bool:
+    text = normalize(sql).lstrip("(").upper()
+    return (text.startswith("SELECT") or text.startswith("WITH")) and not _WRITES.search(text)
+
+
+def _explain(conn, sql: str, params) -> tuple:
+    analyze = read_only(sql)
+    options = "ANALYZE, BUFFERS, FORMAT JSON" if analyze else "FORMAT JSON"
+    cur = conn.cursor()
+    try:
+        if analyze:
+            # the cursor has just begun a transaction; nothing in it may write
+            cur.execute("SET TRANSACTION READ ONLY")
+        # a plan that takes too long to capture is not worth holding a backend for
+        cur.execute(f"SET LOCAL statement_timeout = {int(QUERY_PROFILE_EXPLAIN_TIMEOUT_MS)}")
+        cur.execute(f"EXPLAIN ({options}) {sql.strip().rstrip(';')}", params)
+        plan = cur.fetchall()[0][0]
+    finally:
+        conn.rollback()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return analyze, plan
+
+
+def _write(entry: dict):
+    with open(QUERY_PROFILE_LOG, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+
+
+def _explain_loop():
+    conn = None
+    while True:
+        key, label, text, sql, params, seconds, at = _plans.get()
+        entry = {"at": at.isoformat(timespec="seconds"), "fingerprint": key, "statement": label,
+                 "ms": round(seconds * 1000, 1), "query": text}
+        try:
+            if conn is None:
+                conn = connect()
+            entry["analyzed"], entry["plan"] = _explain(conn, sql, params)
+        except Exception as e:
+            # the statement is still worth logging without its plan
+            entry["error"] = str(e)
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                conn = None
+        try:
+            _write(entry)
+        except OSError:
+            logger.exception("cannot write %s", QUERY_PROFILE_LOG)
+
+
+def enable():
+    global _explainer
+    if _explainer is None:
+        add_query_hook(record)
+        _explainer = threading.Thread(target=_explain_loop, name="explain", daemon=True)
+        _explainer.start()
+        logger.info("profiling queries, plans of those over %sms go to %s", QUERY_PROFILE_SLOW_MS, QUERY_PROFILE_LOG)
+
+
+def enabled() -> bool:
+    return _explainer is not None
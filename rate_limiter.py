@@ -0,0 +1,217 @@
+import asyncio
+import heapq
+import logging
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+import metrics
+from config import (
+    OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_BURST, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST,
+    OUTBOUND_GROUP_RATE, OUTBOUND_GROUP_BURST, OUTBOUND_MAX_RETRIES,
+)
+
+logger = logging.getLogger(__name__)
+
+# rate_limit_args of a request picks its lane; the lower rank goes first
+LANE_INTERACTIVE = "interactive"
+LANE_BULK = "bulk"
+LANES = {LANE_INTERACTIVE: 0, LANE_BULK: 1}
+
+# idle per-chat buckets are dropped once there are more than this many
+MAX_IDLE_CHATS = 1024
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "lock")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        # keeps one chat's messages in the order they were sent
+        self.lock = asyncio.Lock()
+
+    def delay(self) -> float:
+        # seconds until a token is free; when that is now, the token is taken
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def idle(self) -> bool:
+        return not self.lock.locked() and self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+
+class LaneStats:
+    __slots__ = ("waiting", "sent", "retried", "failed", "wait_total", "wait_max")
+
+    def __init__(self):
+        self.waiting = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "waiting": self.waiting,
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "wait_avg": self.wait_total / self.sent if self.sent else 0.0,
+            "wait_max": self.wait_max,
+        }
+
+
+class OutboundLimiter(BaseRateLimiter):
+    # Every Bot API request aimed at a chat passes a per-chat bucket and then
+    # the global bucket. Requests waiting for a global token are released
+    # interactive lane first, so a burst of reminders never holds up replies.
+    # A RetryAfter from Telegram pauses all sending for the time it asks for,
+    # then the request is queued again, still ahead of its chat's later ones.
+
+    def __init__(self, global_rate: float = OUTBOUND_GLOBAL_RATE, global_burst: float = OUTBOUND_GLOBAL_BURST,
+                 chat_rate: float = OUTBOUND_CHAT_RATE, chat_burst: float = OUTBOUND_CHAT_BURST,
+                 group_rate: float = OUTBOUND_GROUP_RATE, group_burst: float = OUTBOUND_GROUP_BURST,
+                 max_retries: int = OUTBOUND_MAX_RETRIES):
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self._global = None
+        self._chats = {}
+        self._waiting = []
+        self._seq = 0
+        self._wakeup = None
+        self._paused_until = 0.0
+        self._pump_task = None
+        self.stats = {lane: LaneStats() for lane in LANES}
+
+    async def initialize(self):
+        if self.global_rate:
+            self._global = TokenBucket(self.global_rate, self.global_burst)
+            self._wakeup = asyncio.Event()
+            self._pump_task = asyncio.create_task(self._pump())
+
+    async def shutdown(self):
+        if self._pump_task is not None:
+            self._pump_task.cancel()
+            self._pump_task = None
+
+    def snapshot(self) -> dict:
+        return {lane: stats.as_dict() for lane, stats in self.stats.items()}
+
+    def collect(self):
+        # for metrics.add_collector; reads plain counters, so safe off the loop
+        families = [
+            ("bot_outbound_waiting", "gauge", "Requests waiting for a send slot", "waiting"),
+            ("bot_outbound_sent_total", "counter", "Requests sent", "sent"),
+            ("bot_outbound_retried_total", "counter", "Requests retried after a flood limit", "retried"),
+            ("bot_outbound_failed_total", "counter", "Requests that failed", "failed"),
+            ("bot_outbound_wait_seconds_total", "counter", "Time requests waited for a send slot", "wait_total"),
+        ]
+        return [(name, kind, help, [({"lane": lane}, getattr(stats, field)) for lane, stats in self.stats.items()])
+                for name, kind, help, field in families]
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > MAX_IDLE_CHATS:
+                for key in [k for k, b in self._chats.items() if b.idle()]:
+                    del self._chats[key]
+            # negative ids and @usernames are groups and channels
+            group = isinstance(chat_id, str) or chat_id < 0
+            bucket = self._chats[chat_id] = (TokenBucket(self.group_rate, self.group_burst) if group
+                                             else TokenBucket(self.chat_rate, self.chat_burst))
+        return bucket
+
+    async def _global_slot(self, lane: str):
+        if self._global is None:
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiting, (LANES[lane], self._seq, future))
+        self._wakeup.set()
+        await future
+
+    async def _pump(self):
+        while True:
+            await self._wakeup.wait()
+            while self._waiting:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                    continue
+                delay = self._global.delay()
+                if delay:
+                    await asyncio.sleep(delay)
+                    continue
+                while self._waiting:
+                    future = heapq.heappop(self._waiting)[2]
+                    if not future.done():
+                        future.set_result(None)
+                        break
+            self._wakeup.clear()
+
+    async def _send(self, lane, chat_id, endpoint, callback, args, kwargs):
+        # The chat's lock is held until the request has gone out or given up,
+        # retries included, so a later message to the chat cannot overtake it.
+        queued = time.monotonic()
+        stats = self.stats[lane]
+        stats.waiting += 1
+        try:
+            bucket = self._chat_bucket(chat_id)
+            async with bucket.lock:
+                for attempt in range(self.max_retries + 1):
+                    if bucket.rate:
+                        while (delay := bucket.delay()) > 0:
+                            await asyncio.sleep(delay)
+                    await self._global_slot(lane)
+                    waited = time.monotonic() - queued
+                    try:
+                        with metrics.timer(metrics.BOT_API, endpoint):
+                            return await callback(*args, **kwargs), waited
+                    except RetryAfter as e:
+                        if attempt == self.max_retries:
+                            logger.error("%s to %s failed after %d retries: %s", endpoint, chat_id, attempt, e)
+                            raise
+                        stats.retried += 1
+                        # Telegram's wait, stretched a little more on every attempt
+                        backoff = e.retry_after + 0.1 * 2 ** attempt
+                        self._paused_until = max(self._paused_until, time.monotonic() + backoff)
+                        logger.warning("flood limit on %s, retrying in %.1fs", endpoint, backoff)
+                        await asyncio.sleep(backoff)
+        finally:
+            stats.waiting -= 1
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            # callback answers, getMe and the like are not messages to a chat
+            with metrics.timer(metrics.BOT_API, endpoint):
+                return await callback(*args, **kwargs)
+        lane = rate_limit_args if rate_limit_args in LANES else LANE_INTERACTIVE
+        stats = self.stats[lane]
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+
+        try:
+            result, waited = await self._send(lane, chat_id, endpoint, callback, args, kwargs)
+        except Exception:
+            stats.failed += 1
+            raise
+        stats.sent += 1
+        stats.wait_total += waited
+        stats.wait_max = max(stats.wait_max, waited)
+        return result
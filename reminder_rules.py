@@ -0,0 +1,88 @@
+import datetime
+from typing import Optional
+
+# A recurring reminder is one row whose rule says how to find its next
+# remind_at once the current one has been delivered:
+#   daily            every day at the time of remind_at
+#   weekdays         Monday to Friday at that time
+#   weekly:1,3,5     on the listed ISO weekdays (1 = Monday) at that time
+#   session:30       every 30 minutes while the employee is at work
+# NULL is a one-off reminder.
+RULE_DAILY = "daily"
+RULE_WEEKDAYS = "weekdays"
+RULE_WEEKLY = "weekly"
+RULE_SESSION = "session"
+
+WEEKDAY_NAMES = ["пн", "вт", "ср", "чт", "пт", "сб", "вс"]
+
+
+def weekly_rule(days) -> str:
+    return f"{RULE_WEEKLY}:" + ",".join(str(d) for d in sorted(set(days)))
+
+
+def session_rule(minutes: int) -> str:
+    return f"{RULE_SESSION}:{minutes}"
+
+
+def parse_weekdays(text: str) -> Optional[list]:
+    # "пн ср пт" or "пн,ср,пт" -> [1, 3, 5]; None if any name is unknown
+    names = text.lower().replace(",", " ").split()
+    if not names or any(name not in WEEKDAY_NAMES for name in names):
+        return None
+    return sorted({WEEKDAY_NAMES.index(name) + 1 for name in names})
+
+
+def _days(rule: str) -> set:
+    if rule == RULE_DAILY:
+        return set(range(1, 8))
+    if rule == RULE_WEEKDAYS:
+        return set(range(1, 6))
+    return {int(d) for d in rule.split(":", 1)[1].split(",")}
+
+
+def session_minutes(rule: str) -> Optional[int]:
+    if rule and rule.startswith(RULE_SESSION + ":"):
+        return int(rule.split(":", 1)[1])
+    return None
+
+
+def first_fire(rule: Optional[str], at: datetime.datetime) -> datetime.datetime:
+    # moves a requested start onto the first day the rule allows
+    if not rule or session_minutes(rule):
+        return at
+    days = _days(rule)
+    while at.isoweekday() not in days:
+        at += datetime.timedelta(days=1)
+    return at
+
+
+def next_fire(rule: str, last: datetime.datetime, now: datetime.datetime) -> datetime.datetime:
+    # the first occurrence after both the delivered one and now, so a
+    # reminder that was due during downtime fires once and then moves on
+    minutes = session_minutes(rule)
+    if minutes:
+        step = datetime.timedelta(minutes=minutes)
+        return last + step if last + step > now else now + step
+
+    days = _days(rule)
+    at = last + datetime.timedelta(days=1)
+    if at <= now:
+        at = datetime.datetime.combine(now.date(), last.time())
+        if at <= now:
+            at += datetime.timedelta(days=1)
+    while at.isoweekday() not in days:
+        at += datetime.timedelta(days=1)
+    return at
+
+
+def describe_rule(rule: Optional[str]) -> str:
+    if not rule:
+        return "один раз"
+    minutes = session_minutes(rule)
+    if minutes:
+        return f"каждые {minutes} мин. на смене"
+    if rule == RULE_DAILY:
+        return "каждый день"
+    if rule == RULE_WEEKDAYS:
+        return "по будням"
+    return "по дням: " + ", ".join(WEEKDAY_NAMES[d - 1] for d in sorted(_days(rule)))
@@ -0,0 +1,86 @@
+import datetime
+import heapq
+import logging
+
+from telegram.error import BadRequest, Forbidden
+from config import REMINDER_BATCH_SIZE, REMINDER_REFILL_SECONDS, REMINDER_TICK_SECONDS, REMINDER_WINDOW_SECONDS
+from database import run_db
+from models import claim_reminders, load_pending_reminders, release_reminder
+from rate_limiter import LANE_BULK
+
+logger = logging.getLogger(__name__)
+
+# The reminders table is the schedule. Only reminders due before the horizon,
+# at most REMINDER_WINDOW_SECONDS ahead, are held here as (remind_at, id) in a
+# heap; the rest wait in the table until a refill reaches them. After a restart
+# the first refill picks up everything overdue along with the new window.
+_heap = []
+_queued = {}  # reminder id -> remind_at of its live heap entry
+_horizon = None
+_next_refill = None
+
+
+def _push(remind_at: datetime.datetime, reminder_id: int):
+    # a reminder moved to another time gets a new entry; the old one is
+    # skipped when it comes up
+    if _queued.get(reminder_id) != remind_at:
+        _queued[reminder_id] = remind_at
+        heapq.heappush(_heap, (remind_at, reminder_id))
+
+
+def schedule(reminder_id: int, remind_at: datetime.datetime):
+    # reminders further out are loaded by a later refill
+    if _horizon is not None and remind_at < _horizon:
+        _push(remind_at, reminder_id)
+
+
+def _load_window(until: datetime.datetime):
+    # The whole window is read again on every refill, so rows written by other
+    # processes are picked up too; queued ids are skipped by _push.
+    rows, after = [], (datetime.datetime.min, 0)
+    while True:
+        page = load_pending_reminders(until, after, REMINDER_BATCH_SIZE)
+        rows.extend(page)
+        if len(page) < REMINDER_BATCH_SIZE:
+            return rows
+        after = tuple(page[-1])
+
+
+async def tick(context):
+    global _horizon, _next_refill
+    now = datetime.datetime.now()
+    if _next_refill is None or now >= _next_refill:
+        _horizon = now + datetime.timedelta(seconds=REMINDER_WINDOW_SECONDS)
+        for remind_at, reminder_id in await run_db(_load_window, _horizon):
+            _push(remind_at, reminder_id)
+        _next_refill = now + datetime.timedelta(seconds=REMINDER_REFILL_SECONDS)
+
+    due = []
+    while _heap and _heap[0][0] <= now and len(due) < REMINDER_BATCH_SIZE:
+        remind_at, reminder_id = heapq.heappop(_heap)
+        if _queued.get(reminder_id) != remind_at:
+            continue
+        del _queued[reminder_id]
+        due.append(reminder_id)
+    if not due:
+        return
+    claimed = await run_db(claim_reminders, due)
+    if claimed:
+        # sending can take a while; the next tick must not wait for it
+        context.application.create_task(_deliver(context.bot, claimed))
+
+
+async def _deliver(bot, claimed):
+    for reminder_id, chat_id, message in claimed:
+        try:
+            await bot.send_message(chat_id=chat_id, text=f"Напоминание: {message}", rate_limit_args=LANE_BULK)
+        except (BadRequest, Forbidden) as e:
+            # the chat is gone or blocked the bot; retrying will not help
+            logger.warning("reminder %s dropped: %s", reminder_id, e)
+        except Exception:
+            logger.exception("reminder %s not sent, will retry", reminder_id)
+            await run_db(release_reminder, reminder_id)
+
+
+def start(job_queue):
+    job_queue.run_repeating(tick, interval=REMINDER_TICK_SECONDS, first=0, name="reminders")
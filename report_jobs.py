@@ -0,0 +1,221 @@
+import asyncio
+import datetime
+import logging
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from telegram.error import BadRequest
+from config import REPORT_WORKERS
+from database import run_db
+from models import REPORT_TOTALS, get_report_cutoff, report_cache
+from reporting import build_excel_report, load_report_totals, merge_totals, render_text_report
+
+logger = logging.getLogger(__name__)
+
+REPORT_TEXT = "text"
+REPORT_EXCEL = "excel"
+
+# Telegram refuses longer messages
+MESSAGE_LIMIT = 4096
+
+STATUS_TEXT = {
+    "queued": "Отчёт поставлен в очередь…",
+    "running": "Отчёт формируется…",
+}
+
+
+def _render(fmt, department_id, division_id, start_date, end_date, cutoff, closed_totals):
+    # Runs in a worker process. Days before cutoff can no longer change: their
+    # per-employee totals come from closed_totals when the parent had them
+    # cached, otherwise they are loaded and handed back for caching. Days from
+    # cutoff on are always summed fresh. The Excel detail sheet streams every
+    # day of the period from the database and is never cached in parts. An
+    # Excel file is handed back as a temp file path, removed once delivered.
+    loaded = None
+    closed_end = min(end_date, cutoff - datetime.timedelta(days=1))
+    if closed_totals is None and start_date <= closed_end:
+        closed_totals = loaded = load_report_totals(department_id, division_id, start_date, closed_end)
+    parts = [] if closed_totals is None else [closed_totals]
+    if end_date >= cutoff:
+        parts.append(load_report_totals(department_id, division_id, max(start_date, cutoff), end_date))
+    totals = merge_totals(parts)
+
+    if fmt == REPORT_TEXT:
+        return render_text_report(totals, start_date, end_date), loaded
+    with tempfile.NamedTemporaryFile(prefix="report_", suffix=".xlsx", delete=False) as f:
+        try:
+            build_excel_report(department_id, division_id, start_date, end_date, output=f, totals=totals)
+        except BaseException:
+            os.unlink(f.name)
+            raise
+    return f.name, loaded
+
+
+class ReportJob:
+    def __init__(self, key):
+        self.key = key
+        self.status = "queued"
+        self.waiters = []  # (chat_id, message_id) of every requester
+
+
+# identical requests in flight share one job
+_jobs = {}
+_slots = asyncio.Semaphore(REPORT_WORKERS)
+_executor = None
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # spawn: children must not inherit the parent's pooled DB sockets
+        _executor = ProcessPoolExecutor(max_workers=REPORT_WORKERS,
+                                        mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+
+def shutdown():
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def _edit(bot, chat_id, message_id, text) -> bool:
+    try:
+        await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+    except BadRequest as e:
+        # the requester may have seen this status already
+        if "not modified" not in str(e):
+            logger.warning("report status update failed: %s", e)
+            return False
+    return True
+
+
+async def _tell(bot, chat_id, message_id, text):
+    # a final outcome: edited into the status message, or sent anew if that
+    # message cannot be edited any more
+    if not await _edit(bot, chat_id, message_id, text):
+        try:
+            await bot.send_message(chat_id=chat_id, text=text)
+        except Exception:
+            logger.exception("report outcome to chat %s not sent", chat_id)
+
+
+def split_text(text: str, limit: int = MESSAGE_LIMIT) -> list:
+    # whole lines per message where they fit, a line longer than that is cut
+    parts, current = [], ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if current:
+                parts.append(current)
+                current = ""
+            parts.append(line[:limit])
+            line = line[limit:]
+        if current and len(current) + 1 + len(line) > limit:
+            parts.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current or not parts:
+        parts.append(current)
+    return parts
+
+
+async def _show_status(bot, job, waiters):
+    for chat_id, message_id in waiters:
+        await _edit(bot, chat_id, message_id, STATUS_TEXT[job.status])
+
+
+async def submit_report(bot, fmt, department_id, division_id, start_date, end_date, chat_id, message_id):
+    key = (fmt, department_id, division_id, start_date, end_date)
+    job = _jobs.get(key)
+    if job is not None:
+        job.waiters.append((chat_id, message_id))
+        await _show_status(bot, job, [(chat_id, message_id)])
+        return
+
+    cache_key = (department_id, division_id, start_date, end_date, fmt)
+    job = _jobs[key] = ReportJob(key)
+    job.waiters.append((chat_id, message_id))
+    try:
+        cutoff = await run_db(get_report_cutoff, department_id, division_id, datetime.date.today())
+        closed = end_date < cutoff
+        # a closed period's text, or the file_id of its uploaded Excel file
+        result = report_cache.get(cache_key) if closed else None
+        cached = result is not None
+        if not cached:
+            await _show_status(bot, job, job.waiters)
+            closed_end = min(end_date, cutoff - datetime.timedelta(days=1))
+            totals_key = (department_id, division_id, start_date, closed_end, REPORT_TOTALS)
+            async with _slots:
+                job.status = "running"
+                await _show_status(bot, job, job.waiters)
+                loop = asyncio.get_running_loop()
+                result, loaded = await loop.run_in_executor(
+                    _get_executor(), _render, *key, cutoff, report_cache.get(totals_key))
+            if loaded is not None:
+                report_cache.set(totals_key, loaded)
+            if closed and fmt == REPORT_TEXT:
+                report_cache.set(cache_key, result)
+    except Exception:
+        logger.exception("report job %s failed", key)
+        _jobs.pop(key, None)
+        for chat_id, message_id in job.waiters:
+            await _tell(bot, chat_id, message_id, "Не удалось сформировать отчёт. Попробуйте позже.")
+        return
+
+    # later requests start a fresh job: the data may have changed by then
+    _jobs.pop(key, None)
+    if fmt == REPORT_TEXT:
+        await _deliver_text(bot, job, result)
+        return
+    file_id = await _deliver_excel(bot, job, result if cached else None, None if cached else result,
+                                   start_date, end_date)
+    if closed and file_id and not cached:
+        report_cache.set(cache_key, file_id)
+
+
+async def _deliver_text(bot, job, text):
+    # the first part replaces the status message, the rest follow it
+    first, *rest = split_text(text)
+    for chat_id, message_id in job.waiters:
+        await _tell(bot, chat_id, message_id, first)
+        try:
+            for part in rest:
+                await bot.send_message(chat_id=chat_id, text=part)
+        except Exception:
+            logger.exception("report delivery to chat %s failed", chat_id)
+            await _tell(bot, chat_id, message_id, "Отчёт отправлен не полностью. Попробуйте позже или выберите Excel.")
+
+
+async def _deliver_excel(bot, job, file_id, path, start_date, end_date):
+    # The worker's file at path is uploaded from disk, never held by this
+    # process beyond one upload; once Telegram has it, the next requesters get
+    # it by file_id. The file is removed afterwards. Returns the file_id.
+    try:
+        for chat_id, message_id in job.waiters:
+            try:
+                if file_id is None:
+                    with open(path, "rb") as document:
+                        msg = await _send_excel(bot, chat_id, document, start_date, end_date)
+                    if msg.document:
+                        file_id = msg.document.file_id
+                else:
+                    await _send_excel(bot, chat_id, file_id, start_date, end_date)
+                await _edit(bot, chat_id, message_id, "Вот ваш Excel-файл с отчётом.")
+            except Exception:
+                logger.exception("report delivery to chat %s failed", chat_id)
+                await _tell(bot, chat_id, message_id, "Не удалось отправить файл с отчётом. Попробуйте позже.")
+    finally:
+        if path is not None:
+            os.unlink(path)
+    return file_id
+
+
+async def _send_excel(bot, chat_id, document, start_date, end_date):
+    return await bot.send_document(
+        chat_id=chat_id,
+        document=document,
+        filename=f"report_{start_date}_{end_date}.xlsx",
+        caption=f"Отчёт за {start_date} — {end_date}",
+    )
@@ -0,0 +1,107 @@
+import datetime
+import tempfile
+
+from openpyxl import Workbook
+from config import REPORT_DETAIL_SHEET, REPORT_FETCH_SIZE, REPORT_SPOOL_MAX_BYTES
+from database import connection
+from models import get_division_report, stream_division_days
+
+SUMMARY_HEADER = ["ФИО", "Дней", "Отработано", "Ср. в день", "Переработка"]
+DETAIL_HEADER = ["ФИО", "Дата", "Отработано", "Перерывы", "Сессий"]
+
+
+def format_hours_minutes(seconds: float) -> str:
+    total_seconds = int(seconds)
+    hours = total_seconds // 3600
+    minutes = (total_seconds % 3600) // 60
+    return f"{hours} ч. {minutes:02d} мин."
+
+
+def load_report_totals(department_id: int, division_id: int,
+                       start_date: datetime.date, end_date: datetime.date) -> list:
+    # one (employee_id, full_name, shifts, worked_seconds, overtime_seconds)
+    # per employee, summed by the database rather than from the day rows
+    return get_division_report(department_id, division_id, start_date, end_date)
+
+
+def merge_totals(parts: list) -> list:
+    # totals of consecutive periods, oldest first, added up per employee
+    if len(parts) == 1:
+        return parts[0]
+    merged = {}
+    for part in parts:
+        for employee_id, full_name, shifts, worked, overtime in part:
+            item = merged.get(employee_id)
+            if item is None:
+                merged[employee_id] = [employee_id, full_name, shifts, worked, overtime]
+            else:
+                # the latest name wins
+                item[1] = full_name
+                item[2] += shifts
+                item[3] += worked
+                item[4] += overtime
+    return sorted((tuple(item) for item in merged.values()), key=lambda row: (row[1], row[0]))
+
+
+def summary_rows(totals: list):
+    for employee_id, full_name, shifts, worked, overtime in totals:
+        yield [
+            full_name,
+            shifts,
+            format_hours_minutes(worked),
+            format_hours_minutes(worked / shifts),
+            format_hours_minutes(overtime),
+        ]
+
+
+def render_text_report(totals: list, start_date: datetime.date, end_date: datetime.date) -> str:
+    if not totals:
+        return f"За период {start_date} — {end_date} данных не найдено."
+    lines = [f"Отчёт за период {start_date} — {end_date}:"]
+    lines.extend(
+        f"{name}: дней: {shifts}, общее: {total}, ср. в день: {avg}, overtime: {overtime}"
+        for name, shifts, total, avg, overtime in summary_rows(totals)
+    )
+    return "\n".join(lines)
+
+
+def render_excel_report(totals: list, days=None, output=None):
+    # days, when given, is an iterable of (full_name, day, worked_seconds,
+    # break_seconds, session_count) for the detail sheet, written as it is
+    # read. Without an explicit output the file stays in memory up to
+    # REPORT_SPOOL_MAX_BYTES and spills to a temporary file beyond that.
+    if output is None:
+        output = tempfile.SpooledTemporaryFile(max_size=REPORT_SPOOL_MAX_BYTES)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Отчёт")
+    ws.append(SUMMARY_HEADER)
+    for row in summary_rows(totals):
+        ws.append(row)
+
+    if days is not None:
+        ws = wb.create_sheet("По дням")
+        ws.append(DETAIL_HEADER)
+        for full_name, day, worked, breaks, sessions in days:
+            ws.append([full_name, day, format_hours_minutes(worked), format_hours_minutes(breaks), sessions])
+    wb.save(output)
+    output.seek(0)
+    return output
+
+
+def build_text_report(department_id: int, division_id: int,
+                      start_date: datetime.date, end_date: datetime.date) -> str:
+    totals = load_report_totals(department_id, division_id, start_date, end_date)
+    return render_text_report(totals, start_date, end_date)
+
+
+def build_excel_report(department_id: int, division_id: int,
+                       start_date: datetime.date, end_date: datetime.date,
+                       detail: bool = REPORT_DETAIL_SHEET, output=None, totals: list = None):
+    # the detail sheet comes straight from a server-side cursor
+    if totals is None:
+        totals = load_report_totals(department_id, division_id, start_date, end_date)
+    if not detail:
+        return render_excel_report(totals, output=output)
+    with connection() as conn:
+        days = stream_division_days(conn, department_id, division_id, start_date, end_date, REPORT_FETCH_SIZE)
+        return render_excel_report(totals, days, output)